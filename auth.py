@@ -2,9 +2,9 @@ from datetime import timedelta, datetime, timezone
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel, EmailStr
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, select
 from starlette import status
-from database import SessionLocal
+from database import db_dependency
 from models import User
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
@@ -12,6 +12,7 @@ from jose import jwt, JWTError
 from dotenv import load_dotenv
 import os
 import re
+import time
 
 load_dotenv()
  
@@ -26,6 +27,11 @@ router = APIRouter(
 )
 
 
+# Hot user lookups, built once with bound parameters
+USER_BY_EMAIL = select(User).where(User.email == bindparam("email")).limit(1)
+USER_BY_ID = select(User).where(User.id == bindparam("user_id")).limit(1)
+
+
 bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme=OAuth2PasswordBearer(tokenUrl="auth/login")
 
@@ -52,21 +58,11 @@ class UpdatePasswordRequest(BaseModel):
     new_password: str
     password: str
 
-# Database dependency
-def get_db():
-    db=SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
-
 
 @router.post("/signup", status_code=status.HTTP_201_CREATED)
 async def create_user(db:db_dependency, create_user_request: UserBase):
     try:
-        db_user = db.query(User).filter(User.email == create_user_request.email).first()
+        db_user = db.scalars(USER_BY_EMAIL, {"email": create_user_request.email}).first()
         if db_user:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User with this email already exists.")
         
@@ -130,7 +126,7 @@ async def login_for_access_token(form_data:Annotated[OAuth2PasswordRequestForm,
 
 # Checks for user and password
 def authenticate_user(email:str, password:str, db):
-    user = db.query(User).filter(User.email == email).first()
+    user = db.scalars(USER_BY_EMAIL, {"email": email}).first()
     if not user:
         return False
     if not bcrypt_context.verify(password, user.password):
@@ -149,25 +145,42 @@ def create_access_token(data:dict, expires_delta:timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-# Validate token and return user information
-async def get_current_user(token:Annotated[str, Depends(oauth2_scheme)]):
+# Decoded tokens are cached until they expire, so repeat calls with the
+# same bearer token skip the signature check and JSON parsing
+TOKEN_CACHE_SIZE = 4096
+token_cache = {}
+
+# Validates a token and returns its payload; shared by get_current_user and the fast path
+def decode_token(token:str):
+    payload = token_cache.get(token)
+    if payload is not None:
+        if payload["exp"] > time.time():
+            return payload
+        token_cache.pop(token, None)
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email:str = payload.get("email")
-        id:int = payload.get("id")
-        name:str = payload.get("name")
-        if email is None or id is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token is invalid or expired")
-        return payload
     except JWTError:
         raise HTTPException(status_code=403,
         detail="Token is invalid or expired" )
+    email:str = payload.get("email")
+    id:int = payload.get("id")
+    if email is None or id is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token is invalid or expired")
+    if "exp" in payload:
+        if len(token_cache) >= TOKEN_CACHE_SIZE:
+            token_cache.clear()
+        token_cache[token] = payload
+    return payload
+
+# Validate token and return user information
+async def get_current_user(token:Annotated[str, Depends(oauth2_scheme)]):
+    return decode_token(token)
 
 user_dependency = Annotated[dict, Depends(get_current_user)]
 
 # Returns user if active JWT
 @router.get("/verify", status_code=status.HTTP_200_OK)
-async def user(user:user_dependency, db:db_dependency):
+async def user(user:user_dependency):
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authentication failed")
     return {"User": user}
@@ -176,7 +189,7 @@ async def user(user:user_dependency, db:db_dependency):
 @router.delete("/deleteUser/{user_id}", status_code=status.HTTP_200_OK)
 async def delete_post(user_id:int, request:DeleteUserRequest, db:db_dependency, user:user_dependency):
     try:
-        db_user = db.query(User).filter(User.id == user_id).first()
+        db_user = db.scalars(USER_BY_ID, {"user_id": user_id}).first()
         if db_user is None:
             raise HTTPException(status_code=404, detail="User not found")
         if not authenticate_user(db_user.email, request.password, db):
@@ -191,7 +204,7 @@ async def delete_post(user_id:int, request:DeleteUserRequest, db:db_dependency,
 @router.put("/updateEmail/{user_id}", status_code=status.HTTP_200_OK)
 async def update_email(user_id: int, request:UpdateEmailRequest, db: db_dependency, user:user_dependency):
     try:
-        db_user = db.query(User).filter(User.id == user_id).first()
+        db_user = db.scalars(USER_BY_ID, {"user_id": user_id}).first()
         if db_user is None:
             raise HTTPException(status_code=404, detail="User not found")
         if not authenticate_user(db_user.email, request.password, db):
@@ -206,7 +219,7 @@ async def update_email(user_id: int, request:UpdateEmailRequest, db: db_dependen
 @router.put("/updatePassword/{user_id}", status_code=status.HTTP_200_OK)
 async def update_password(user_id:int, request:UpdatePasswordRequest, db:db_dependency, user:user_dependency):
     try:
-        db_user = db.query(User).filter(User.id == user_id).first()
+        db_user = db.scalars(USER_BY_ID, {"user_id": user_id}).first()
         if db_user is None:
             raise HTTPException(status_code=404, detail="User not found")
         if not authenticate_user(db_user.email, request.password, db):
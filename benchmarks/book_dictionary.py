@@ -0,0 +1,50 @@
+# Table and index sizes of the shelf tables with bookKey strings on every row
+# versus bookId references into the books dictionary. Builds the old layout
+# in a throwaway SQLite database, fills it with synthetic Open Library keys,
+# then runs migrations/002_book_dictionary.py, which prints both sizes.
+#
+#   python benchmarks/book_dictionary.py [users] [books per user] [distinct keys]
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "migrations"))
+os.environ["URL_DATABASE"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ.pop("URL_DATABASE_SHARDS", None)
+
+from sqlalchemy import text
+from database import engine
+
+
+def build_old_layout(users, per_user, distinct):
+    keys = [f"/works/OL{10_000_000 + i}W" for i in range(distinct)]
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR(50), email VARCHAR(100), password VARCHAR(100))"))
+        for table in ("books_to_read", "books_read", "books_reading"):
+            connection.execute(text(
+                f"CREATE TABLE {table} (id INTEGER PRIMARY KEY, bookKey VARCHAR(100) NOT NULL, "
+                f"userId INTEGER NOT NULL REFERENCES users (id), created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL)"
+            ))
+            connection.execute(text(f"CREATE INDEX ix_{table}_id ON {table} (id)"))
+            connection.execute(text(f"CREATE UNIQUE INDEX ix_{table}_user_book ON {table} (userId, bookKey)"))
+            connection.execute(
+                text(f"INSERT INTO {table} (bookKey, userId, created_at, updated_at) VALUES (:key, :user, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)"),
+                [{"key": key, "user": user} for user in range(1, users + 1) for key in random.sample(keys, per_user)]
+            )
+
+
+def main(users, per_user, distinct):
+    build_old_layout(users, per_user, distinct)
+    spec = importlib.util.spec_from_file_location("book_dictionary", os.path.join(ROOT, "migrations", "002_book_dictionary.py"))
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+    migration.migrate(engine)
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:4]]
+    main(*(args + [1000, 50, 20000][len(args):]))
@@ -0,0 +1,83 @@
+# Cold-cache shelf list latency for large users with the rows clustered by
+# id (the default) versus by (userId, id) (SHELF_CLUSTERED_BY_USER). Rows are
+# inserted round-robin across users, as real shelves fill up, so with an id
+# key one user's rows are spread across the whole table.
+#
+# SQLite stands in for InnoDB: a rowid table is clustered by id and a
+# WITHOUT ROWID table by its primary key. Before each read the database file
+# is dropped from the OS page cache (posix_fadvise, Linux) and a new
+# connection is opened, so every page comes from disk.
+#
+#   python benchmarks/clustered_key.py [users] [books per user] [reads]
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+
+COLUMNS = "id INTEGER NOT NULL, bookId INTEGER NOT NULL, userId INTEGER NOT NULL, created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL"
+LAYOUTS = {
+    "id": f"CREATE TABLE books_read ({COLUMNS}, PRIMARY KEY (id))",
+    "(userId, id)": f"CREATE TABLE books_read ({COLUMNS}, PRIMARY KEY (userId, id)) WITHOUT ROWID",
+}
+LIST = text("SELECT id, bookId, userId, created_at, updated_at FROM books_read WHERE userId = :user_id")
+
+
+def build(path, create_table, users, per_user):
+    engine = create_engine(f"sqlite:///{path}", poolclass=NullPool)
+    with engine.begin() as connection:
+        connection.execute(text(create_table))
+        connection.execute(text("CREATE UNIQUE INDEX ix_books_read_user_book ON books_read (userId, bookId)"))
+        connection.execute(
+            text("INSERT INTO books_read (id, bookId, userId, created_at, updated_at) "
+                 "VALUES (:id, :book_id, :user_id, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)"),
+            [{"id": position * users + user, "book_id": position, "user_id": user}
+             for position in range(per_user) for user in range(1, users + 1)]
+        )
+    return engine
+
+
+def drop_from_page_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def cold_reads(engine, path, user_ids):
+    timings = []
+    for user_id in user_ids:
+        drop_from_page_cache(path)
+        start = time.perf_counter()
+        with engine.connect() as connection:
+            connection.execute(LIST, {"user_id": user_id}).all()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main(users, per_user, reads):
+    if not hasattr(os, "posix_fadvise"):
+        sys.exit("posix_fadvise is not available on this platform")
+    directory = tempfile.mkdtemp()
+    user_ids = random.sample(range(1, users + 1), min(reads, users))
+    print(f"{users} users x {per_user} books, {len(user_ids)} cold reads")
+    print(f"{'primary key':<16}{'file MiB':>10}{'median ms':>11}{'p95 ms':>9}")
+    for index, (name, create_table) in enumerate(LAYOUTS.items()):
+        path = os.path.join(directory, f"layout{index}.db")
+        engine = build(path, create_table, users, per_user)
+        timings = sorted(cold_reads(engine, path, user_ids))
+        size = os.path.getsize(path) / 2**20
+        print(f"{name:<16}{size:>10.1f}{statistics.median(timings):>11.2f}{timings[int(len(timings) * 0.95)]:>9.2f}")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:4]]
+    main(*(args + [2000, 250, 50][len(args):]))
@@ -0,0 +1,86 @@
+# Shelf read and insert throughput per database driver. Drivers that are not
+# installed are skipped. Defaults to a throwaway SQLite file (pysqlite vs
+# aiosqlite); point URL_DATABASE at a local MySQL to compare pymysql,
+# mysqldb (mysqlclient), mysqlconnector, asyncmy and aiomysql.
+#
+#   python benchmarks/drivers.py [rows] [reads]
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("URL_DATABASE", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+from sqlalchemy import create_engine, delete, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session
+import models
+from database import ASYNC_DRIVERS, URL_DATABASE, with_driver
+from shelves import add_books, list_books
+
+DRIVERS = {
+    "mysql": ["pymysql", "mysqldb", "mysqlconnector", "asyncmy", "aiomysql"],
+    "sqlite": ["pysqlite", "aiosqlite"],
+}
+
+
+def reset(db):
+    db.execute(delete(models.BooksRead).where(models.BooksRead.userId == 1))
+    db.commit()
+
+
+def write_and_read(db, rows, reads):
+    reset(db)
+    keys = [f"/works/OL{i}W" for i in range(rows)]
+    start = time.perf_counter()
+    for offset in range(0, rows, 100):
+        add_books(db, models.BooksRead, 1, keys[offset:offset + 100])
+        db.commit()
+    inserts = rows / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(reads):
+        list_books(db, models.BooksRead, 1)
+    return inserts, reads * rows / (time.perf_counter() - start)
+
+
+async def run_async(url, rows, reads):
+    engine = create_async_engine(url)
+    try:
+        async with AsyncSession(engine, expire_on_commit=False) as db:
+            return await db.run_sync(write_and_read, rows, reads)
+    finally:
+        await engine.dispose()
+
+
+def main(rows, reads):
+    backend = make_url(URL_DATABASE).get_backend_name()
+    setup = create_engine(URL_DATABASE)
+    models.Base.metadata.create_all(bind=setup)
+    with Session(setup) as db:
+        if db.get(models.User, 1) is None:
+            db.add(models.User(id=1, name="bench", email="bench@example.com", password="x"))
+            db.commit()
+    setup.dispose()
+
+    print(f"{'driver':<16}{'inserts/s':>12}{'rows read/s':>14}")
+    for driver in DRIVERS.get(backend, []):
+        url = with_driver(URL_DATABASE, driver)
+        try:
+            if driver in ASYNC_DRIVERS:
+                inserts, rows_read = asyncio.run(run_async(url, rows, reads))
+            else:
+                engine = create_engine(url)
+                with Session(engine, expire_on_commit=False) as db:
+                    inserts, rows_read = write_and_read(db, rows, reads)
+                engine.dispose()
+        except ImportError as exc:
+            print(f"{driver:<16}skipped ({exc.name} not installed)")
+            continue
+        print(f"{driver:<16}{inserts:>12.0f}{rows_read:>14.0f}")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    main(*(args + [2000, 50][len(args):]))
@@ -0,0 +1,93 @@
+# Requests per second for the hot GET routes with and without the fast path.
+# Each mode runs in its own process against a throwaway SQLite database
+# (or URL_DATABASE if set) and drives the full ASGI app in-process.
+#
+#   python benchmarks/fast_path.py [iterations]
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+ROUTES = ["/auth/verify", "/books-read/1", "/books-read/1?format=keys"]
+
+
+def setup_environment():
+    os.environ.setdefault("URL_DATABASE", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("ALGORITHM", "HS256")
+    os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+    os.environ.setdefault("ORIGIN", "http://localhost")
+
+
+async def call(app, path, token):
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "root_path": "", "query_string": query.encode(),
+        "headers": [(b"authorization", b"Bearer " + token.encode())],
+        "client": ("127.0.0.1", 1234), "server": ("127.0.0.1", 8000),
+    }
+    statuses = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    await app(scope, receive, send)
+    assert statuses == [200], statuses
+
+
+async def run(iterations):
+    sys.path.insert(0, ROOT)
+    import main
+    import models
+    from auth import create_access_token
+    from database import SessionLocal
+    from shelves import add_books
+
+    with SessionLocal() as db:
+        if db.get(models.User, 1) is None:
+            db.add(models.User(id=1, name="bench", email="bench@example.com", password="x"))
+            add_books(db, models.BooksRead, 1, [f"/works/OL{i}W" for i in range(25)])
+            db.commit()
+    token = create_access_token({"email": "bench@example.com", "id": 1, "name": "bench"})
+
+    for path in ROUTES:
+        for _ in range(100):
+            await call(main.app, path, token)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await call(main.app, path, token)
+        elapsed = time.perf_counter() - start
+        print(f"{path}\t{iterations / elapsed:.0f}")
+
+
+def main(iterations):
+    setup_environment()
+    results = {}
+    for mode in ("0", "1"):
+        output = subprocess.run(
+            [sys.executable, __file__, "--worker", str(iterations)],
+            env={**os.environ, "FAST_PATH": mode}, capture_output=True, text=True, check=True
+        ).stdout
+        for line in output.strip().splitlines():
+            path, rps = line.split("\t")
+            results.setdefault(path, {})[mode] = float(rps)
+
+    print(f"{'route':<28}{'dependencies':>14}{'fast path':>12}{'speedup':>10}")
+    for path, modes in results.items():
+        print(f"{path:<28}{modes['0']:>11.0f}/s{modes['1']:>9.0f}/s{modes['1'] / modes['0']:>9.2f}x")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--worker"]:
+        asyncio.run(run(int(sys.argv[2])))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
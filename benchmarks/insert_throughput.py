@@ -0,0 +1,69 @@
+# Shelf insert throughput: the old ORM unit-of-work path (one object and one
+# commit per book) against shelves.add_books with a Core executemany INSERT.
+# Runs against a throwaway SQLite database unless URL_DATABASE is set.
+#
+#   python benchmarks/insert_throughput.py [rows]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("URL_DATABASE", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+from sqlalchemy import delete
+from sqlalchemy.orm import sessionmaker
+import models
+from database import SessionLocal, engine
+from books import book_dictionary
+from shelves import add_books
+
+LegacySession = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def orm_per_row(keys):
+    with LegacySession() as db:
+        for key in keys:
+            book_id = book_dictionary.get_ids(db, [key], create=True)[key]
+            db.add(models.BooksRead(bookId=book_id, userId=1))
+            db.commit()
+
+
+def core_per_row(keys):
+    with SessionLocal() as db:
+        for key in keys:
+            add_books(db, models.BooksRead, 1, [key])
+            db.commit()
+
+
+def core_batched(keys, batch_size=100):
+    with SessionLocal() as db:
+        for start in range(0, len(keys), batch_size):
+            add_books(db, models.BooksRead, 1, keys[start:start + batch_size])
+            db.commit()
+
+
+def main(rows):
+    models.Base.metadata.create_all(bind=engine)
+    with SessionLocal() as db:
+        if db.get(models.User, 1) is None:
+            db.add(models.User(id=1, name="bench", email="bench@example.com", password="x"))
+            db.commit()
+
+    print(f"{'write path':<32}{'rows/s':>10}")
+    for name, write in [
+        ("ORM add + commit per row", orm_per_row),
+        ("Core insert + commit per row", core_per_row),
+        ("Core executemany, 100 per batch", core_batched),
+    ]:
+        with SessionLocal() as db:
+            db.execute(delete(models.BooksRead).where(models.BooksRead.userId == 1))
+            db.commit()
+        keys = [f"/works/OL{i}W" for i in range(rows)]
+        start = time.perf_counter()
+        write(keys)
+        print(f"{name:<32}{rows / (time.perf_counter() - start):>10.0f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,85 @@
+# Measures what each middleware layer adds to a trivial request.
+# Requests are driven straight through the ASGI app, so no network or
+# database is involved and the numbers only reflect Python overhead.
+#
+#   python benchmarks/middleware_overhead.py [iterations]
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware as StarletteCORSMiddleware
+from middleware import CompressionMiddleware, CORSMiddleware
+
+ORIGIN = "https://app.example.com"
+
+
+def build_app(layers):
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    for layer, options in layers:
+        app.add_middleware(layer, **options)
+    return app
+
+
+STACKS = {
+    "bare app": [],
+    "starlette CORS": [(StarletteCORSMiddleware, {"allow_origins": [ORIGIN], "allow_credentials": True, "allow_methods": ["*"], "allow_headers": ["*"]})],
+    "pure ASGI CORS": [(CORSMiddleware, {"allow_origins": ORIGIN, "allow_credentials": True})],
+    "compression": [(CompressionMiddleware, {})],
+    "compression + CORS": [(CompressionMiddleware, {}), (CORSMiddleware, {"allow_origins": ORIGIN, "allow_credentials": True})],
+}
+
+
+async def call(app, method="GET", headers=()):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": "/ping", "raw_path": b"/ping",
+        "root_path": "", "query_string": b"", "headers": list(headers),
+        "client": ("127.0.0.1", 1234), "server": ("127.0.0.1", 8000),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def measure(app, iterations, method="GET", headers=()):
+    for _ in range(200):
+        await call(app, method, headers)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await call(app, method, headers)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+async def main(iterations):
+    headers = [(b"origin", ORIGIN.encode()), (b"accept-encoding", b"gzip, br")]
+    preflight = [(b"origin", ORIGIN.encode()), (b"access-control-request-method", b"POST"), (b"access-control-request-headers", b"authorization, content-type")]
+
+    baseline = None
+    print(f"{'stack':<24}{'us/request':>12}{'added':>10}")
+    for name, layers in STACKS.items():
+        per_request = await measure(build_app(layers), iterations, headers=headers)
+        baseline = per_request if baseline is None else baseline
+        print(f"{name:<24}{per_request:>12.1f}{per_request - baseline:>+10.1f}")
+
+    print(f"\n{'preflight':<24}{'us/request':>12}")
+    for name in ("starlette CORS", "pure ASGI CORS"):
+        per_request = await measure(build_app(STACKS[name]), iterations, method="OPTIONS", headers=preflight)
+        print(f"{name:<24}{per_request:>12.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
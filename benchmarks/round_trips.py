@@ -0,0 +1,68 @@
+# Counts driver round trips (statements plus COMMIT/ROLLBACK) per shelf read
+# for the server-default transaction versus the read-only autocommit session
+# GET routes now use. Runs against a throwaway SQLite database unless
+# URL_DATABASE is set, e.g. to a local MySQL.
+#
+#   python benchmarks/round_trips.py [requests]
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("URL_DATABASE", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import models
+from database import LazySession, SessionLocal, engine, get_engine
+from shelves import add_books, list_books
+
+counts = {"statements": 0, "transaction": 0}
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    counts["statements"] += 1
+
+
+# Count COMMIT/ROLLBACK only when they reach the driver: the autocommit
+# engine replaces these on its own dialect instance and is not counted
+def count_transaction_calls(dialect_class):
+    for name in ("do_commit", "do_rollback"):
+        original = getattr(dialect_class, name)
+
+        def counted(self, dbapi_connection, original=original):
+            counts["transaction"] += 1
+            return original(self, dbapi_connection)
+
+        setattr(dialect_class, name, counted)
+
+
+def main(requests):
+    models.Base.metadata.create_all(bind=engine)
+    with SessionLocal() as db:
+        if db.get(models.User, 1) is None:
+            db.add(models.User(id=1, name="bench", email="bench@example.com", password="x"))
+            add_books(db, models.BooksRead, 1, [f"/works/OL{i}W" for i in range(50)])
+            db.commit()
+
+    count_transaction_calls(type(engine.dialect))
+    results = {}
+    for level in (None, "AUTOCOMMIT"):
+        get_engine(level)
+        counts.update(statements=0, transaction=0)
+        for _ in range(requests):
+            with LazySession(isolation_level=level) as db:
+                list_books(db, models.BooksRead, 1)
+        results[level or "server default"] = (counts["statements"] / requests, counts["transaction"] / requests)
+
+    print(f"{'session':<18}{'statements':>12}{'commit/rollback':>17}{'round trips':>13}")
+    for name, (statements, transaction) in results.items():
+        print(f"{name:<18}{statements:>12.2f}{transaction:>17.2f}{statements + transaction:>13.2f}")
+    before = sum(results["server default"])
+    after = sum(results["AUTOCOMMIT"])
+    print(f"\nround trips saved per read request: {before - after:.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
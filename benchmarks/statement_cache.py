@@ -0,0 +1,74 @@
+# Per-call Python overhead of the hot lookups: legacy db.query(...).filter(...)
+# chains rebuilt on every call versus the module-level statements with bound
+# parameters. Uses an in-memory SQLite database so driver time stays small.
+#
+#   python benchmarks/statement_cache.py [iterations]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ["URL_DATABASE"] = "sqlite://"
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+import models
+from auth import USER_BY_EMAIL, USER_BY_ID
+from shelves import SHELF_FIELDS, add_books, existing_ids_statement, list_books
+
+engine = create_engine("sqlite://", poolclass=StaticPool)
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+Book = models.BooksRead
+User = models.User
+
+CASES = [
+    (
+        "book by (userId, bookId)",
+        lambda db: db.query(Book.bookId).filter(Book.bookId.in_([7]), Book.userId == 1).first(),
+        lambda db: db.scalars(existing_ids_statement(Book), {"user_id": 1, "book_ids": [7]}).first(),
+    ),
+    (
+        "shelf list by userId",
+        lambda db: db.query(Book).filter(Book.userId == 1).all(),
+        lambda db: list_books(db, Book, 1, SHELF_FIELDS),
+    ),
+    (
+        "user by email",
+        lambda db: db.query(User).filter(User.email == "bench@example.com").first(),
+        lambda db: db.scalars(USER_BY_EMAIL, {"email": "bench@example.com"}).first(),
+    ),
+    (
+        "user by id",
+        lambda db: db.query(User).filter(User.id == 1).first(),
+        lambda db: db.scalars(USER_BY_ID, {"user_id": 1}).first(),
+    ),
+]
+
+
+def per_call(db, query, iterations):
+    for _ in range(200):
+        query(db)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        query(db)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main(iterations):
+    models.Base.metadata.create_all(bind=engine)
+    with Session() as db:
+        db.add(User(id=1, name="bench", email="bench@example.com", password="x"))
+        add_books(db, Book, 1, [f"/works/OL{i}W" for i in range(10)])
+        db.commit()
+
+    print(f"{'query':<28}{'query chain':>13}{'cached stmt':>13}{'saved':>9}")
+    with Session() as db:
+        for name, legacy, cached in CASES:
+            before = per_call(db, legacy, iterations)
+            after = per_call(db, cached, iterations)
+            print(f"{name:<28}{before:>11.1f}us{after:>11.1f}us{before - after:>7.1f}us")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
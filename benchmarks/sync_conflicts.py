@@ -0,0 +1,67 @@
+# Checks that /library/{user_id}/sync resolves conflicts by when the changes
+# were made on the devices, not by when they reached the server, then times
+# merges of offline change logs of growing size. Uses an in-memory SQLite
+# database.
+#
+#   python benchmarks/sync_conflicts.py [iterations]
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ["URL_DATABASE"] = "sqlite://"
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+import models
+from shelves import ClientChange, list_books, sync_library
+
+engine = create_engine("sqlite://", poolclass=StaticPool)
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+
+def sync(user_id, since, changes):
+    with Session() as db:
+        rejected, _, version, _ = sync_library(db, user_id, since, changes)
+        db.commit()
+    return rejected, version
+
+
+def read_shelf(user_id):
+    with Session() as db:
+        return list_books(db, models.BooksRead, user_id, format="keys")
+
+
+# Two devices start from version 0. A adds a book at 09:00 and syncs first;
+# B removed it at 10:00 and syncs later, so B's later edit wins. A device
+# whose edit is older than the server's then loses.
+def check_last_writer_wins():
+    sync(1, 0, [ClientChange("read", "/works/OL1W", "add", datetime(2024, 5, 1, 9), 0)])
+    rejected, version = sync(1, 0, [ClientChange("read", "/works/OL1W", "remove", datetime(2024, 5, 1, 10), 0)])
+    assert rejected == [] and read_shelf(1) == [], (rejected, read_shelf(1))
+    rejected, _ = sync(1, 0, [ClientChange("read", "/works/OL1W", "add", datetime(2024, 5, 1, 9, 30), 0)])
+    assert rejected == [{"shelf": "read", "bookKey": "/works/OL1W", "op": "add"}] and read_shelf(1) == [], (rejected, read_shelf(1))
+    print("last writer wins on edit time: ok")
+
+
+def main(iterations):
+    models.Base.metadata.create_all(bind=engine)
+    with Session() as db:
+        db.add_all([models.User(id=user_id, name="bench", email=f"bench{user_id}@example.com", password="x") for user_id in (1, 2)])
+        db.commit()
+    check_last_writer_wins()
+
+    print(f"{'changes':>8}{'per sync':>12}")
+    for size in (10, 100, 1000):
+        start = time.perf_counter()
+        for iteration in range(iterations):
+            edited = datetime(2024, 5, 1, 12, 0, iteration % 60)
+            op = "add" if iteration % 2 == 0 else "remove"
+            sync(2, 0, [ClientChange("read", f"/works/OL{size}_{index}W", op, edited, 0) for index in range(size)])
+        print(f"{size:>8}{(time.perf_counter() - start) / iterations * 1000:>10.1f}ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
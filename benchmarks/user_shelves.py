@@ -0,0 +1,77 @@
+# Per-call latency of the user-created shelf reads for one large user
+# (hundreds of shelves, tens of thousands of books), with every book on a
+# few shelves: books on a shelf (one page), shelves holding a book, and the
+# shelf list with sizes. Prints SQLite's query plans so the index searches
+# can be checked. Uses an in-memory SQLite database.
+#
+#   python benchmarks/user_shelves.py [shelves] [books] [shelves per book]
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ["URL_DATABASE"] = "sqlite://"
+
+from sqlalchemy import bindparam, create_engine, insert, update
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+import models
+import user_shelves
+from user_shelves import list_user_shelves, user_shelf_listing
+
+engine = create_engine("sqlite://", poolclass=StaticPool)
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+
+def seed(shelf_count, book_count, per_book):
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(insert(models.User), [{"id": 1, "name": "bench", "email": "bench@example.com", "password": "x"}])
+        connection.execute(insert(models.UserShelf), [{"id": index, "userId": 1, "name": f"shelf {index:04d}"} for index in range(1, shelf_count + 1)])
+        connection.execute(insert(models.Book), [{"id": index, "bookKey": f"/works/OL{index}W"} for index in range(1, book_count + 1)])
+        rows = [
+            {"shelfId": shelf_id, "bookId": book_id, "userId": 1}
+            for book_id in range(1, book_count + 1)
+            for shelf_id in random.sample(range(1, shelf_count + 1), per_book)
+        ]
+        connection.execute(insert(models.UserShelfBook), rows)
+        counts = dict.fromkeys(range(1, shelf_count + 1), 0)
+        for row in rows:
+            counts[row["shelfId"]] += 1
+        connection.execute(
+            update(models.UserShelf.__table__).where(models.UserShelf.__table__.c.id == bindparam("shelf_id")).values(book_count=bindparam("n")),
+            [{"shelf_id": shelf_id, "n": n} for shelf_id, n in counts.items()]
+        )
+    return len(rows)
+
+
+def per_call(query, iterations):
+    with Session() as db:
+        for _ in range(20):
+            query(db)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            query(db)
+    return (time.perf_counter() - start) / iterations * 1e3
+
+
+def main(shelf_count, book_count, per_book, iterations=500):
+    rows = seed(shelf_count, book_count, per_book)
+    print(f"1 user, {shelf_count} shelves, {book_count} books, {rows} shelf entries")
+    cases = [
+        ("books on a shelf (100)", user_shelves.PAGE_STATEMENT, lambda db: user_shelf_listing(db, 1, shelf_count // 2, "keys", 100, 0)),
+        ("shelves holding a book", user_shelves.BOOK_SHELVES_STATEMENT, lambda db: list_user_shelves(db, 1, f"/works/OL{book_count // 2}W")),
+        ("shelf list with sizes", user_shelves.SHELVES_STATEMENT, lambda db: list_user_shelves(db, 1)),
+    ]
+    print(f"{'query':<26}{'per call':>10}  plan")
+    with engine.connect() as connection:
+        for name, statement, query in cases:
+            sql = str(statement.compile(engine))
+            plan = [row[-1] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + sql, (1,) * sql.count("?"))]
+            print(f"{name:<26}{per_call(query, iterations):>8.3f}ms  {'; '.join(plan)}")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:4]]
+    main(*(args + [300, 30000, 3][len(args):]))
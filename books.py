@@ -0,0 +1,90 @@
+from sqlalchemy import bindparam, event, insert, select
+from sqlalchemy.orm import Session
+from database import shard_of
+import models
+
+Book = models.Book
+
+SELECT_IDS = select(Book.bookKey, Book.id).where(Book.bookKey.in_(bindparam("book_keys", expanding=True)))
+# A locking read sees rows other transactions committed after ours started
+SELECT_IDS_LOCKED = SELECT_IDS.with_for_update(read=True)
+INSERT_IGNORE = insert(Book).prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite")
+
+
+# Returns {bookKey: id} for the keys already in the dictionary
+def fetch_ids(executor, book_keys, locked: bool = False):
+    statement = SELECT_IDS_LOCKED if locked else SELECT_IDS
+    return dict(executor.execute(statement, {"book_keys": list(book_keys)}).all())
+
+# Adds keys to the dictionary (concurrent inserts of the same key are
+# ignored) and returns {bookKey: id} for all of them
+def create_ids(executor, book_keys):
+    executor.execute(INSERT_IGNORE, [{"bookKey": key} for key in book_keys])
+    return fetch_ids(executor, book_keys, locked=True)
+
+
+# In-process cache of bookKey -> id per shard. Ids created inside a
+# transaction are only cached once it commits, so a rollback (of the
+# transaction or of the savepoint that created them) cannot leave ids behind
+# that do not exist.
+class BookDictionary:
+    def __init__(self, max_size: int = 200_000):
+        self.max_size = max_size
+        self.ids = {}
+
+    def remember(self, entries):
+        if len(self.ids) + len(entries) > self.max_size:
+            self.ids.clear()
+        self.ids.update(entries)
+
+    def get_ids(self, db, book_keys, create: bool = False):
+        shard = shard_of(db)
+        found, missing = {}, []
+        for key in book_keys:
+            book_id = self.ids.get((shard, key))
+            if book_id is None:
+                missing.append(key)
+            else:
+                found[key] = book_id
+        if not missing:
+            return found
+
+        pending = db.info.setdefault("pending_book_ids", {})
+        fetched = fetch_ids(db, missing)
+        found.update(fetched)
+        self.remember({(shard, key): book_id for key, book_id in fetched.items() if (shard, key) not in pending})
+        missing = [key for key in missing if key not in fetched]
+        if create and missing:
+            created = create_ids(db, missing)
+            found.update(created)
+            savepoint = db.get_nested_transaction()
+            pending.update({(shard, key): (book_id, savepoint) for key, book_id in created.items()})
+        return found
+
+
+book_dictionary = BookDictionary()
+
+@event.listens_for(Session, "after_commit")
+def _cache_created_ids(session):
+    if session.in_nested_transaction():
+        return
+    pending = session.info.pop("pending_book_ids", None)
+    if pending:
+        book_dictionary.remember({entry: book_id for entry, (book_id, _) in pending.items()})
+
+def _inside(transaction, savepoint):
+    while transaction is not None:
+        if transaction is savepoint:
+            return True
+        transaction = transaction.parent
+    return False
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_created_ids(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop("pending_book_ids", None)
+        return
+    pending = session.info.get("pending_book_ids")
+    if pending:
+        for entry in [entry for entry, (_, savepoint) in pending.items() if _inside(savepoint, previous_transaction)]:
+            del pending[entry]
@@ -0,0 +1,38 @@
+# Drops shelf_changes rows older than the retention period and records, per
+# user, the newest version dropped, so /library/{user_id}/changes answers
+# 410 to clients whose since is older than that. Run it from cron.
+#
+#   python compact_changes.py [--days 30]
+import argparse
+from datetime import timedelta
+from sqlalchemy import delete, func, select, update
+import models
+from database import shelf_engines
+
+Change = models.ShelfChange.__table__
+Version = models.UserVersion.__table__
+
+
+def compact(shelf_engine, days: float):
+    cutoff = models.utc_now() - timedelta(days=days)
+    with shelf_engine.connect() as connection:
+        horizons = connection.execute(
+            select(Change.c.userId, func.max(Change.c.version)).where(Change.c.created_at < cutoff).group_by(Change.c.userId)
+        ).all()
+    dropped = 0
+    for user_id, through in horizons:
+        with shelf_engine.begin() as connection:
+            connection.execute(
+                update(Version).where(Version.c.userId == user_id, Version.c.compacted_through < through).values(compacted_through=through)
+            )
+            dropped += connection.execute(delete(Change).where(Change.c.userId == user_id, Change.c.version <= through)).rowcount
+    print(f"{shelf_engine.url.render_as_string()}: dropped {dropped} changes of {len(horizons)} users")
+    return dropped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drop old shelf change log rows")
+    parser.add_argument("--days", type=float, default=30, help="keep changes this many days (default 30)")
+    args = parser.parse_args()
+    for shelf_engine in shelf_engines():
+        compact(shelf_engine, args.days)
@@ -1,15 +1,274 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import Pool
+from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from fastapi import Depends, Request
+from typing import Annotated
 from dotenv import load_dotenv
+import logging
 import os
+import time
+from replicas import ReplicaSet
+from sharding import ShardMap
 
 load_dotenv()
 
 URL_DATABASE = os.getenv("URL_DATABASE")
 
-engine = create_engine(URL_DATABASE)
+# DB_DRIVER swaps the driver in URL_DATABASE without touching the rest of it:
+# a sync driver such as "mysqldb" (mysqlclient, C) replaces it for the app
+# engine; an async driver ("asyncmy", "aiomysql", "aiosqlite") adds
+# async_engine next to it, which the fast path reads through.
+DB_DRIVER = os.getenv("DB_DRIVER") or None
+ASYNC_DRIVERS = ("asyncmy", "aiomysql", "aiosqlite")
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def with_driver(url: str, driver: str | None):
+    if driver is None:
+        return url
+    parsed = make_url(url)
+    return parsed.set(drivername=f"{parsed.get_backend_name()}+{driver}").render_as_string(hide_password=False)
 
-Base = declarative_base()
\ No newline at end of file
+ASYNC_DRIVER = DB_DRIVER if DB_DRIVER in ASYNC_DRIVERS else None
+ENGINE_URL = URL_DATABASE if ASYNC_DRIVER else with_driver(URL_DATABASE, DB_DRIVER)
+
+engine = create_engine(ENGINE_URL)
+
+# Sends queries on sharded models (sharded = True, the shelf tables) to the
+# shard of session.info["user_id"] (set through use_user); everything else
+# uses the normal bind
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if shards and mapper is not None and getattr(mapper.class_, "sharded", False):
+            user_id = self.info.get("user_id")
+            if user_id is None:
+                raise LookupError(f"No user set for a query on {mapper.persist_selectable.name}")
+            return shards.engine_for(user_id, self.info.get("isolation_level"))
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+# expire_on_commit=False: nothing we hand back after commit needs a reload SELECT
+SessionLocal = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+Base = declarative_base()
+
+# GET/HEAD routes default to READ_ISOLATION_LEVEL, everything else to
+# WRITE_ISOLATION_LEVEL. An empty value means the server default
+# (REPEATABLE READ on InnoDB). Routes can override with @isolation_level.
+READ_ISOLATION_LEVEL = os.getenv("READ_ISOLATION_LEVEL", "AUTOCOMMIT") or None
+WRITE_ISOLATION_LEVEL = os.getenv("WRITE_ISOLATION_LEVEL") or None
+READ_METHODS = ("GET", "HEAD")
+
+# One engine (and pool) per isolation level, so the level is set once when a
+# connection is opened instead of on every checkout
+engines = {None: engine}
+
+def engine_options(isolation_level: str | None):
+    options = {"isolation_level": isolation_level}
+    if isolation_level == "AUTOCOMMIT":
+        options["pool_reset_on_return"] = None
+    return options
+
+# COMMIT/ROLLBACK are no-ops on the server in autocommit mode but the driver
+# still sends them; skip the round trip
+def skip_autocommit_round_trips(level_engine, isolation_level: str | None):
+    if isolation_level == "AUTOCOMMIT":
+        level_engine.dialect.do_commit = level_engine.dialect.do_rollback = lambda dbapi_connection: None
+
+def get_engine(isolation_level: str | None = None):
+    if isolation_level not in engines:
+        level_engine = create_engine(ENGINE_URL, **engine_options(isolation_level))
+        skip_autocommit_round_trips(level_engine, isolation_level)
+        engines.setdefault(isolation_level, level_engine)
+    return engines[isolation_level]
+
+# Async engine for reads when DB_DRIVER names an async driver
+async_engine = None
+AsyncSessionLocal = None
+if ASYNC_DRIVER:
+    async_engine = create_async_engine(with_driver(URL_DATABASE, ASYNC_DRIVER), **engine_options(READ_ISOLATION_LEVEL))
+    skip_autocommit_round_trips(async_engine.sync_engine, READ_ISOLATION_LEVEL)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Optional read replicas (comma-separated URLs). GET sessions read from them
+# unless the user wrote within REPLICA_LAG_WINDOW seconds.
+URL_DATABASE_REPLICAS = [url.strip() for url in os.getenv("URL_DATABASE_REPLICAS", "").split(",") if url.strip()]
+REPLICA_LAG_WINDOW = float(os.getenv("REPLICA_LAG_WINDOW", "5"))
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", "10"))
+
+def replica_engine(url: str):
+    replica = create_engine(with_driver(url, None if ASYNC_DRIVER else DB_DRIVER), pool_pre_ping=True, **engine_options(READ_ISOLATION_LEVEL))
+    skip_autocommit_round_trips(replica, READ_ISOLATION_LEVEL)
+    return replica
+
+replicas = ReplicaSet(
+    [replica_engine(url) for url in URL_DATABASE_REPLICAS],
+    lag_window=REPLICA_LAG_WINDOW,
+    retry_interval=REPLICA_HEALTH_INTERVAL
+)
+
+# Optional user-id shards for the shelf tables (comma-separated URLs)
+URL_DATABASE_SHARDS = [url.strip() for url in os.getenv("URL_DATABASE_SHARDS", "").split(",") if url.strip()]
+SHARD_DIRECTORY_TTL = float(os.getenv("SHARD_DIRECTORY_TTL", "5"))
+
+def shard_engine(url: str, isolation_level: str | None):
+    level_engine = create_engine(with_driver(url, None if ASYNC_DRIVER else DB_DRIVER), **engine_options(isolation_level))
+    skip_autocommit_round_trips(level_engine, isolation_level)
+    return level_engine
+
+shards = ShardMap(URL_DATABASE_SHARDS, shard_engine, directory_engine=engine, directory_ttl=SHARD_DIRECTORY_TTL)
+
+# Engines holding shelf tables: the primary and, when sharded, every shard.
+# Maintenance scripts walk these.
+def shelf_engines():
+    return [engine] + [shards.engine(index) for index in range(len(shards.urls))]
+
+# Cluster shelf rows by (userId, id) instead of id so one user's shelf sits
+# together in the InnoDB clustered index. Needs a backend that auto-generates
+# id inside a composite key (MySQL); migrations/003_shelf_primary_key.py
+# converts existing tables.
+SHELF_CLUSTERED_BY_USER = os.getenv("SHELF_CLUSTERED_BY_USER") == "1"
+if SHELF_CLUSTERED_BY_USER and make_url(URL_DATABASE).get_backend_name() != "mysql":
+    raise RuntimeError("SHELF_CLUSTERED_BY_USER=1 needs a MySQL database")
+
+# Shelf helpers call this before touching a user's rows; it picks the shard
+# and, for writes, refuses users that are mid-move
+def use_user(db, user_id: int, write: bool = False):
+    db.info["user_id"] = user_id
+    if write and shards:
+        shards.check_writable(user_id)
+
+# Which copy of the per-shard tables (such as the book dictionary) the
+# session's current user lives on
+def shard_of(db):
+    return shards.lookup(db.info["user_id"])[0] if shards else 0
+
+# Write helpers call this so the user's next reads stick to the primary once
+# the session commits, and so caches of the user's data are dropped
+def mark_written(db, user_id: int):
+    db.info.setdefault("written_users", set()).add(user_id)
+
+# Called with the id of each user whose data a session changed, once it commits
+commit_listeners = [replicas.record_write]
+
+# after_commit also fires when a savepoint is released; wait for the real commit
+@event.listens_for(Session, "after_commit")
+def _record_writes(session):
+    if session.in_nested_transaction():
+        return
+    for user_id in session.info.pop("written_users", ()):
+        for listener in commit_listeners:
+            listener(user_id)
+
+# Savepoint rollbacks keep them: other work in the transaction may still commit
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_writes(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop("written_users", None)
+
+# Marks a route with the isolation level its session should use
+def isolation_level(level: str | None):
+    def decorator(endpoint):
+        endpoint.isolation_level = level
+        return endpoint
+    return decorator
+
+# Marks a POST route that only reads (a lookup too large for a query string)
+# so it gets the read isolation level and read replicas like a GET
+def read_only(endpoint):
+    endpoint.read_only = True
+    return endpoint
+
+# Per-request session stats are logged here; DB_SESSION_STATS=1 prints them
+logger = logging.getLogger("database")
+if os.getenv("DB_SESSION_STATS") == "1":
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+
+# Request-scoped session that only builds the real Session (and checks out a
+# connection) the first time it is used. Routes that never query pay nothing.
+# Read sessions (read=True) go to a replica when one is configured and
+# healthy, unless user_id has written recently.
+class LazySession:
+    def __init__(self, factory=SessionLocal, isolation_level: str | None = None, read: bool = False, user_id: int | None = None):
+        self._factory = factory
+        self.isolation_level = isolation_level
+        self.read = read
+        self.user_id = user_id
+        self._connection = None
+        self._session = None
+        self.started = time.perf_counter()
+        self.query_count = 0
+
+    @property
+    def session(self):
+        if self._session is None:
+            bind = None
+            if self.read and replicas:
+                bind = self._connection = replicas.connect(self.user_id)
+            self._session = self._factory(bind=bind or get_engine(self.isolation_level))
+            self._session.info["stats"] = self
+            self._session.info["isolation_level"] = self.isolation_level
+        return self._session
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        logger.info(
+            "db session: %d queries, %.2f ms",
+            self.query_count, (time.perf_counter() - self.started) * 1000
+        )
+
+
+# Points the checked-out connection at the request's stats so every
+# statement, ORM or Core, is counted
+@event.listens_for(Session, "after_begin")
+def _track_connection(session, transaction, connection):
+    stats = session.info.get("stats")
+    if stats is not None:
+        connection.info["stats"] = stats
+
+@event.listens_for(Pool, "checkin")
+def _untrack_connection(dbapi_connection, connection_record):
+    connection_record.info.pop("stats", None)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    stats = conn.info.get("stats")
+    if stats is not None:
+        stats.query_count += 1
+
+
+# Shared database dependency; FastAPI caches it so every dependency in a
+# request receives the same LazySession
+def get_db(request: Request):
+    endpoint = request.scope.get("endpoint")
+    read = request.method in READ_METHODS or getattr(endpoint, "read_only", False)
+    if hasattr(endpoint, "isolation_level"):
+        level = endpoint.isolation_level
+    elif read:
+        level = READ_ISOLATION_LEVEL
+    else:
+        level = WRITE_ISOLATION_LEVEL
+    user_id = request.path_params.get("user_id")
+    db = LazySession(isolation_level=level, read=read, user_id=int(user_id) if user_id and user_id.isdigit() else None)
+    try:
+        yield db
+    finally:
+        db.close()
+
+db_dependency = Annotated[Session, Depends(get_db)]
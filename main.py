@@ -1,42 +1,95 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Request
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Response, Query, Header, BackgroundTasks
+from fastapi.responses import StreamingResponse
 import models
-from database import engine, SessionLocal
-from typing import Annotated
-from sqlalchemy.orm import Session, joinedload, validates
-from pydantic import BaseModel, EmailStr
+from database import engine, db_dependency, LazySession, read_only, replicas, shards, use_user, REPLICA_HEALTH_INTERVAL
+from sharding import create_shard_tables
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import asyncio
+from typing import Annotated, Literal
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload, validates
+from pydantic import BaseModel, EmailStr, Field
 import auth
+from middleware import CompressionMiddleware, CORSMiddleware, IdempotencyMiddleware
+import fastpath
+from fastpath import FastPathMiddleware
+from shelves import SHELVES, MAX_PAGE_SIZE, ClientChange, parse_fields, shelf_listing, library_listing, list_changes, sync_library, add_books, remove_books, move_books, ordered, reorder_book, rebalance_positions, shelf_counts
 from auth import get_current_user
+from membership import lookup_membership
+from push import change_broker
+from user_shelves import list_user_shelves, create_user_shelf, delete_user_shelf, add_to_user_shelf, remove_from_user_shelf, user_shelf_listing
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
 
-app = FastAPI()
+# Pings read replicas in the background so failed ones are retried
+async def check_replicas():
+    while True:
+        await asyncio.to_thread(replicas.check_health)
+        await asyncio.sleep(REPLICA_HEALTH_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    health_task = asyncio.create_task(check_replicas()) if replicas else None
+    push_task = asyncio.create_task(change_broker.run())
+    yield
+    push_task.cancel()
+    if health_task is not None:
+        health_task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(auth.router)
 models.Base.metadata.create_all(bind=engine)
+for shard_index in range(len(shards.urls)):
+    create_shard_tables(shards.engine(shard_index), models.sharded_tables())
 
 ORIGIN = os.getenv("ORIGIN")
 
-# CORS middleware
+# Fast path for the hottest GET routes (added first so it sits innermost)
+app.add_middleware(
+    FastPathMiddleware,
+    routes=[("GET", "/auth/verify", fastpath.verify), ("GET", "/library/{user_id}", fastpath.library)] + [
+        ("GET", f"{shelf.path}/{{user_id}}", fastpath.shelf_list(shelf))
+        for shelf in SHELVES.values()
+    ],
+    enabled=os.getenv("FAST_PATH", "1") != "0"
+)
+
+# Idempotency-Key support for the POST routes mobile clients retry
+app.add_middleware(
+    IdempotencyMiddleware,
+    paths=["/auth/signup", "/shelves/move", "/batch"] + [path for shelf in SHELVES.values() for path in (shelf.path, f"{shelf.path}/batch")],
+    ttl=float(os.getenv("IDEMPOTENCY_TTL", "86400")),
+    max_entries=int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000")),
+    max_bytes=int(os.getenv("IDEMPOTENCY_MAX_BYTES", str(16 << 20)))
+)
+
+# Compression middleware (brotli is used when the package is installed)
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024")),
+    gzip_level=int(os.getenv("COMPRESSION_LEVEL", "6")),
+    brotli_quality=int(os.getenv("BROTLI_QUALITY", "5")),
+    cache_size=int(os.getenv("COMPRESSION_CACHE_SIZE", "512")),
+    cache_bytes=int(os.getenv("COMPRESSION_CACHE_BYTES", str(8 << 20)))
+)
+
+# CORS middleware (ORIGIN is a comma-separated list, "*" wildcards allowed in hosts)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ORIGIN,
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["X-Total-Count", "X-Next-After", "X-Sync-Version", "Idempotent-Replayed"],
+    max_age=int(os.getenv("CORS_MAX_AGE", "600"))
 )
 
-def get_db():
-    db = SessionLocal()
-    try: 
-        yield db
-    finally:
-        db.close()
-
 # Dependencies
-db_dependency = Annotated[Session, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
 
 ## PYDANTIC BASES
@@ -44,88 +97,363 @@ class BooksBase(BaseModel):
     book_key: str
     user_id: int
 
-# BOOKS TO READ 
-@app.post('/books-to-read', status_code=status.HTTP_201_CREATED)
-async def add_book_to_read(post:BooksBase, db: db_dependency, user:user_dependency):
+class BooksBatch(BaseModel):
+    book_keys: list[str] = Field(min_length=1, max_length=500)
+    user_id: int
+
+# Shelf names as used in request bodies ("to-read", "read", "reading")
+ShelfName = Literal[tuple(SHELVES)]
+
+class BooksMove(BaseModel):
+    book_keys: list[str] = Field(min_length=1, max_length=500)
+    user_id: int
+    from_shelf: ShelfName
+    to_shelf: ShelfName
+
+# Operations for /batch, told apart by "op"
+class AddOperation(BaseModel):
+    op: Literal["add"]
+    shelf: ShelfName
+    book_keys: list[str] = Field(min_length=1, max_length=500)
+
+class RemoveOperation(BaseModel):
+    op: Literal["remove"]
+    shelf: ShelfName
+    book_keys: list[str] = Field(min_length=1, max_length=500)
+
+class MoveOperation(BaseModel):
+    op: Literal["move"]
+    from_shelf: ShelfName
+    to_shelf: ShelfName
+    book_keys: list[str] = Field(min_length=1, max_length=500)
+
+class Batch(BaseModel):
+    user_id: int
+    operations: list[Annotated[AddOperation | RemoveOperation | MoveOperation, Field(discriminator="op")]] = Field(min_length=1, max_length=500)
+
+class UserShelfCreate(BaseModel):
+    name: str = Field(min_length=1, max_length=100)
+
+# Places book_key right after after_key on an ordered shelf (null: at the top)
+class BookReorder(BaseModel):
+    book_key: str
+    after_key: str | None = None
+    user_id: int
+
+# An offline client's change log for /library/{user_id}/sync
+class SyncChange(BaseModel):
+    shelf: ShelfName
+    book_key: str
+    op: Literal["add", "remove"]
+    updated_at: datetime
+    version: int | None = Field(default=None, ge=0)
+
+class SyncLog(BaseModel):
+    since: int = Field(ge=0)
+    changes: list[SyncChange] = Field(max_length=MAX_PAGE_SIZE)
+
+class BooksLookup(BaseModel):
+    book_keys: list[str] = Field(min_length=1, max_length=500)
+
+# ?format=keys returns a flat list of bookKey strings
+ListFormat = Literal["objects", "keys"]
+
+# ?limit= and ?after= switch list routes to keyset pages
+PageLimit = Annotated[int | None, Query(ge=1, le=MAX_PAGE_SIZE)]
+
+# SHELVES
+# Registers the add, batch add, list and delete routes for one shelf
+def register_shelf_routes(shelf):
+    model = shelf.model
+
+    async def add_book(post:BooksBase, db: db_dependency, user:user_dependency):
+        try:
+            if not add_books(db, model, post.user_id, [post.book_key]):
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="This book is already in the list")
+            db.commit()
+            return {"detail":"Book added successfully"}
+        except HTTPException:
+            raise
+        except:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    async def add_books_batch(post:BooksBatch, db: db_dependency, user:user_dependency):
+        try:
+            added = add_books(db, model, post.user_id, post.book_keys)
+            db.commit()
+            added_keys = set(added)
+            return {"added": added, "skipped": [key for key in dict.fromkeys(post.book_keys) if key not in added_keys]}
+        except HTTPException:
+            raise
+        except:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    async def retrieve_books(user_id:int, response:Response, db:db_dependency, user:user_dependency, fields:str | None = None, format:ListFormat = "objects", limit:PageLimit = None, after:Annotated[int | None, Query(ge=0)] = None):
+        columns = parse_fields(fields)
+        try:
+            content, headers = shelf_listing(db, shelf, user_id, columns, format, limit, after)
+            response.headers.update(headers)
+            return content
+        except HTTPException:
+            raise
+        except:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    async def delete_book(req:BooksBase, db:db_dependency, user:user_dependency):
+        try:
+            if not remove_books(db, model, req.user_id, [req.book_key]):
+                raise HTTPException(status_code=404, detail="Books not found")
+            db.commit()
+            return {"detail":"Book deleted successfully"}
+        except HTTPException:
+            raise
+        except:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    async def reorder_book_route(req:BookReorder, background_tasks:BackgroundTasks, db:db_dependency, user:user_dependency):
+        try:
+            if reorder_book(db, model, req.user_id, req.book_key, req.after_key):
+                background_tasks.add_task(rebalance_in_background, model, req.user_id)
+            db.commit()
+            return {"detail":"Book moved successfully"}
+        except HTTPException:
+            raise
+        except:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    suffix = shelf.route_suffix
+    app.post(shelf.path, status_code=status.HTTP_201_CREATED, name=f"add_book_{suffix}")(add_book)
+    app.post(f"{shelf.path}/batch", status_code=status.HTTP_201_CREATED, name=f"add_books_{suffix}")(add_books_batch)
+    app.get(f"{shelf.path}/{{user_id}}", status_code=status.HTTP_200_OK, name=f"retrieve_books_{suffix}")(retrieve_books)
+    app.delete(shelf.path, status_code=status.HTTP_200_OK, name=f"delete_book_{suffix}")(delete_book)
+    if ordered(model):
+        app.put(f"{shelf.path}/order", status_code=status.HTTP_200_OK, name=f"reorder_book_{suffix}")(reorder_book_route)
+
+# Respaces an ordered shelf after reorders used up the gaps between positions
+def rebalance_in_background(model, user_id):
+    with LazySession() as db:
+        rebalance_positions(db, model, user_id)
+        db.commit()
+
+for shelf in SHELVES.values():
+    register_shelf_routes(shelf)
+
+
+# Shared by /shelves/move and /batch; raises like the routes do
+def move_operation(db, user_id, from_shelf, to_shelf, book_keys):
+    if from_shelf == to_shelf:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="from_shelf and to_shelf must differ")
+    moved = move_books(db, SHELVES[from_shelf].model, SHELVES[to_shelf].model, user_id, book_keys)
+    if not moved:
+        raise HTTPException(status_code=404, detail="Books not found")
+    return {"moved": moved}
+
+# Moves books between two shelves in one transaction, e.g. to-read -> read
+@app.post("/shelves/move", status_code=status.HTTP_200_OK)
+async def move_between_shelves(req:BooksMove, db:db_dependency, user:user_dependency):
     try:
-        db_book = db.query(models.BooksToRead).filter(
-            models.BooksToRead.bookKey == post.book_key,
-            models.BooksToRead.userId == post.user_id
-            ).first()
-        if db_book:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="This book is already in the list")
-        db_post = models.BooksToRead(bookKey=post.book_key, userId=post.user_id)
-        db.add(db_post)
+        result = move_operation(db, req.user_id, req.from_shelf, req.to_shelf, req.book_keys)
         db.commit()
-        return {"detail":"Book added successfully"}
+        return result
+    except HTTPException:
+        raise
     except:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-@app.get('/books-to-read/{user_id}', status_code=status.HTTP_200_OK)
-async def retrieve_books_to_read(user_id:int, db:db_dependency, user:user_dependency):
-    try:
-        db_books = db.query(models.BooksToRead).filter(models.BooksToRead.userId == user_id).all()
-        if db_books is None:
+
+# Runs one /batch operation; results carry the status the single route
+# would have answered with
+def run_operation(db, user_id, operation):
+    if operation.op == "add":
+        added = add_books(db, SHELVES[operation.shelf].model, user_id, operation.book_keys)
+        added_keys = set(added)
+        skipped = [key for key in dict.fromkeys(operation.book_keys) if key not in added_keys]
+        return {"status": status.HTTP_201_CREATED, "added": added, "skipped": skipped}
+    if operation.op == "remove":
+        removed = remove_books(db, SHELVES[operation.shelf].model, user_id, operation.book_keys)
+        if not removed:
             raise HTTPException(status_code=404, detail="Books not found")
-        return {"books_to_read": db_books}
+        return {"status": status.HTTP_200_OK, "removed": removed}
+    return {"status": status.HTTP_200_OK, **move_operation(db, user_id, operation.from_shelf, operation.to_shelf, operation.book_keys)}
+
+# Replays up to 500 queued shelf operations for one user in order, in one
+# transaction. Each operation runs in a savepoint: a failed one is rolled
+# back and reported while the others still apply.
+@app.post("/batch", status_code=status.HTTP_200_OK)
+async def run_batch(req:Batch, db:db_dependency, user:user_dependency):
+    try:
+        use_user(db, req.user_id, write=True)
+        results = []
+        for operation in req.operations:
+            savepoint = db.begin_nested()
+            try:
+                results.append(run_operation(db, req.user_id, operation))
+                savepoint.commit()
+            except HTTPException as exc:
+                savepoint.rollback()
+                results.append({"status": exc.status_code, "detail": exc.detail})
+            except SQLAlchemyError:
+                savepoint.rollback()
+                results.append({"status": status.HTTP_500_INTERNAL_SERVER_ERROR, "detail": "Operation failed"})
+        db.commit()
+        return {"results": results}
+    except HTTPException:
+        raise
     except:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@app.delete('/books-to-read', status_code=status.HTTP_200_OK)
-async def delete_book_to_read(req:BooksBase, db:db_dependency, user:user_dependency):
+# Every shelf in one query, e.g. for the client's start screen
+@app.get("/library/{user_id}", status_code=status.HTTP_200_OK)
+async def retrieve_library(user_id:int, response:Response, db:db_dependency, user:user_dependency, fields:str | None = None, format:ListFormat = "objects", limit:PageLimit = None, after:str | None = None):
+    columns = parse_fields(fields)
     try:
-        db_book = db.query(models.BooksToRead).filter(
-            models.BooksToRead.bookKey == req.book_key,
-            models.BooksToRead.userId == req.user_id
-            ).first()
-        if db_book is None:
-            raise HTTPException(status_code=404, detail="Books not found")
-        db.delete(db_book)
+        content, headers = library_listing(db, user_id, columns, format, limit, after)
+        response.headers.update(headers)
+        return content
+    except HTTPException:
+        raise
+    except:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# Shelf changes after a sync version (from X-Sync-Version or an earlier call)
+@app.get("/library/{user_id}/changes", status_code=status.HTTP_200_OK)
+async def library_changes(user_id:int, db:db_dependency, user:user_dependency, since:Annotated[int, Query(ge=0)] = 0, limit:Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = MAX_PAGE_SIZE):
+    try:
+        changes, version, more = list_changes(db, user_id, since, limit)
+        return {"version": version, "changes": changes, "more": more}
+    except HTTPException:
+        raise
+    except:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# Times without a zone are taken as UTC, like shelf_changes.created_at
+def utc(moment: datetime):
+    return moment.astimezone(timezone.utc).replace(tzinfo=None) if moment.tzinfo else moment
+
+# Merges an offline client's change log and answers with the changes since
+# the client's version; changes that lost a conflict come back in rejected
+@app.post("/library/{user_id}/sync", status_code=status.HTTP_200_OK)
+async def sync_changes(user_id:int, req:SyncLog, db:db_dependency, user:user_dependency):
+    try:
+        changes = [
+            ClientChange(change.shelf, change.book_key, change.op, utc(change.updated_at), req.since if change.version is None else change.version)
+            for change in req.changes
+        ]
+        rejected, changes, version, more = sync_library(db, user_id, req.since, changes)
         db.commit()
-        return {"detail":"Book deleted successfully"}
+        return {"version": version, "changes": changes, "more": more, "rejected": rejected}
+    except HTTPException:
+        raise
     except:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+# Server-sent events for the signed-in user: a "changes" event with the new
+# sync version after their shelves change, to fetch with /changes?since=.
+# Reconnects send Last-Event-ID and get an event at once if they missed one.
+@app.get("/events", status_code=status.HTTP_200_OK)
+async def shelf_events(request:Request, user:user_dependency, last_event_id:Annotated[int | None, Header(ge=0)] = None):
+    try:
+        subscription = change_broker.subscribe(user["id"], last_event_id)
+        return StreamingResponse(
+            change_broker.stream(request, subscription),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    except HTTPException:
+        raise
+    except:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-# BOOKS READ
-@app.post('/books-read', status_code=status.HTTP_201_CREATED)
-async def add_book_read(post: BooksBase,db: db_dependency, user:user_dependency):
+# Which shelves hold each of up to 500 books, e.g. for search result badges
+@app.post("/library/{user_id}/membership", status_code=status.HTTP_200_OK)
+@read_only
+async def book_membership(user_id:int, req:BooksLookup, db:db_dependency, user:user_dependency):
     try:
-        db_book = db.query(models.BooksRead).filter(
-            models.BooksRead.bookKey == post.book_key,
-            models.BooksRead.userId == post.user_id
-            ).first()
-        if db_book:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="This book is already in the list")
-        db_post = models.BooksRead(bookKey=post.book_key, userId=post.user_id)
-        db.add(db_post)
+        return lookup_membership(db, user_id, req.book_keys)
+    except HTTPException:
+        raise
+    except:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# USER-CREATED SHELVES
+# The user's own shelves by name with their sizes; ?book_key= keeps only the
+# shelves holding that book
+@app.get("/library/{user_id}/shelves", status_code=status.HTTP_200_OK)
+async def retrieve_user_shelves(user_id:int, db:db_dependency, user:user_dependency, book_key:str | None = None):
+    try:
+        return {"shelves": list_user_shelves(db, user_id, book_key)}
+    except HTTPException:
+        raise
+    except:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@app.post("/library/{user_id}/shelves", status_code=status.HTTP_201_CREATED)
+async def create_shelf(user_id:int, req:UserShelfCreate, db:db_dependency, user:user_dependency):
+    try:
+        shelf = create_user_shelf(db, user_id, req.name)
         db.commit()
-        return {"detail":"Book added successfully"}
+        return shelf
+    except HTTPException:
+        raise
     except:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-@app.get('/books-read/{user_id}', status_code=status.HTTP_200_OK)
-async def retrieve_books_read(user_id:int, db:db_dependency, user:user_dependency):
+@app.delete("/library/{user_id}/shelves/{shelf_id}", status_code=status.HTTP_200_OK)
+async def delete_shelf(user_id:int, shelf_id:int, db:db_dependency, user:user_dependency):
     try:
-        db_books = db.query(models.BooksRead).filter(models.BooksRead.userId == user_id).all()
-        if db_books is None:
-            raise HTTPException(status_code=404, detail="Books not found")
-        return {"books_read": db_books}
+        delete_user_shelf(db, user_id, shelf_id)
+        db.commit()
+        return {"detail":"Shelf deleted successfully"}
+    except HTTPException:
+        raise
+    except:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# One page of a shelf's books; pages follow X-Next-After like the shelf lists
+@app.get("/library/{user_id}/shelves/{shelf_id}", status_code=status.HTTP_200_OK)
+async def retrieve_shelf_books(user_id:int, shelf_id:int, response:Response, db:db_dependency, user:user_dependency, format:ListFormat = "objects", limit:PageLimit = None, after:Annotated[int | None, Query(ge=0)] = None):
+    try:
+        content, headers = user_shelf_listing(db, user_id, shelf_id, format, limit, after)
+        response.headers.update(headers)
+        return content
+    except HTTPException:
+        raise
     except:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-@app.delete('/books-read', status_code=status.HTTP_200_OK)
-async def delete_book_read(req:BooksBase, db:db_dependency, user:user_dependency):
+@app.post("/library/{user_id}/shelves/{shelf_id}/books", status_code=status.HTTP_201_CREATED)
+async def add_to_shelf(user_id:int, shelf_id:int, req:BooksLookup, db:db_dependency, user:user_dependency):
     try:
-        db_book = db.query(models.BooksRead).filter(
-            models.BooksRead.bookKey == req.book_key,
-            models.BooksToRead.userId == req.user_id
-            ).first()
-        if db_book is None:
+        added = add_to_user_shelf(db, user_id, shelf_id, req.book_keys)
+        db.commit()
+        added_keys = set(added)
+        return {"added": added, "skipped": [key for key in dict.fromkeys(req.book_keys) if key not in added_keys]}
+    except HTTPException:
+        raise
+    except:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@app.delete("/library/{user_id}/shelves/{shelf_id}/books", status_code=status.HTTP_200_OK)
+async def remove_from_shelf(user_id:int, shelf_id:int, req:BooksLookup, db:db_dependency, user:user_dependency):
+    try:
+        removed = remove_from_user_shelf(db, user_id, shelf_id, req.book_keys)
+        if not removed:
             raise HTTPException(status_code=404, detail="Books not found")
-        db.delete(db_book)
         db.commit()
-        return {"detail":"Book deleted successfully"}
+        return {"removed": removed}
+    except HTTPException:
+        raise
+    except:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# Shelf sizes for badges, read from the shelf_counts counters
+@app.get("/users/{user_id}/stats", status_code=status.HTTP_200_OK)
+async def user_stats(user_id:int, db:db_dependency, user:user_dependency):
+    try:
+        return shelf_counts(db, user_id)
+    except HTTPException:
+        raise
     except:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
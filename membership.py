@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from database import commit_listeners
+from shelves import shelf_keys, shelf_membership
+
+
+# Per-user {bookKey: [shelf names]} maps for membership checks, so a search
+# page's badges are dictionary lookups instead of a query. Entries are
+# dropped when the user's writes commit in this process and expire after ttl
+# seconds, which bounds staleness from writes served by other processes.
+# A load that overlaps a write is not stored.
+class MembershipCache:
+    def __init__(self, max_users: int = 0, ttl: float = 30.0):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def __bool__(self):
+        return self.max_users > 0
+
+    def key_sets(self, db, user_id: int):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(user_id)
+                return entry[1]
+            token = self.loading[user_id] = object()
+        try:
+            keys = shelf_keys(db, user_id)
+        except Exception:
+            with self.lock:
+                if self.loading.get(user_id) is token:
+                    del self.loading[user_id]
+            raise
+        with self.lock:
+            if self.loading.get(user_id) is token:
+                del self.loading[user_id]
+                self.entries[user_id] = (now + self.ttl, keys)
+                self.entries.move_to_end(user_id)
+                while len(self.entries) > self.max_users:
+                    self.entries.popitem(last=False)
+        return keys
+
+    def invalidate(self, user_id: int):
+        with self.lock:
+            self.entries.pop(user_id, None)
+            self.loading.pop(user_id, None)
+
+
+membership_cache = MembershipCache(
+    max_users=int(os.getenv("MEMBERSHIP_CACHE_USERS", "0")),
+    ttl=float(os.getenv("MEMBERSHIP_CACHE_TTL", "30"))
+)
+commit_listeners.append(membership_cache.invalidate)
+
+
+# {bookKey: [shelf names]} for the given keys, from the cache when enabled
+def lookup_membership(db, user_id: int, book_keys):
+    book_keys = list(dict.fromkeys(book_keys))
+    if not membership_cache:
+        return shelf_membership(db, user_id, book_keys)
+    keys = membership_cache.key_sets(db, user_id)
+    return {key: list(keys.get(key, ())) for key in book_keys}
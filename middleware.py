@@ -0,0 +1,369 @@
+import gzip
+import functools
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+
+# Picks the best encoding we support from an Accept-Encoding header.
+# Clients send a handful of distinct headers, so results are memoized.
+@functools.lru_cache(maxsize=128)
+def negotiate_encoding(accept_encoding: str):
+    offered = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        offered[name.strip().lower()] = quality
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_quality = None, 0.0
+    for encoding in candidates:
+        quality = offered.get(encoding, offered.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+# Pure ASGI middleware that tags buffered responses with an ETag, answers
+# If-None-Match with 304 and compresses bodies over minimum_size.
+# Compressed bodies are kept in an LRU keyed by (ETag, encoding) so an
+# unchanged shelf list is only compressed once. The LRU holds at most
+# cache_size bodies and cache_bytes bytes; bodies over an eighth of
+# cache_bytes are not kept.
+# Streaming responses (more_body=True) are passed through untouched.
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 5, cache_size: int = 512, cache_bytes: int = 8 << 20):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encoding = negotiate_encoding(request_headers.get("accept-encoding", ""))
+        if_none_match = request_headers.get("if-none-match")
+        start_message = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            if message.get("more_body", False):
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+            await self.send_buffered(start_message, message.get("body", b""), encoding, if_none_match, send)
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def send_buffered(self, start_message, body, encoding, if_none_match, send):
+        headers = MutableHeaders(raw=start_message["headers"])
+        status_code = start_message["status"]
+        if status_code != 200 or "content-encoding" in headers:
+            await send(start_message)
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        etag = headers.get("etag")
+        if etag is None:
+            etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+            headers["ETag"] = etag
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            del headers["content-length"]
+            if "content-type" in headers:
+                del headers["content-type"]
+            await send({"type": "http.response.start", "status": 304, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if len(body) >= self.minimum_size:
+            headers.add_vary_header("Accept-Encoding")
+            if encoding is not None:
+                body = self.compress(etag, encoding, body)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+        await send(start_message)
+        await send({"type": "http.response.body", "body": body})
+
+    def compress(self, etag, encoding, body):
+        key = (etag, encoding)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache.move_to_end(key)
+            return cached
+        if encoding == "br":
+            compressed = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+        if len(compressed) <= self.cache_bytes // 8:
+            self.cache[key] = compressed
+            self.cached_bytes += len(compressed)
+            while len(self.cache) > self.cache_size or self.cached_bytes > self.cache_bytes:
+                self.cached_bytes -= len(self.cache.popitem(last=False)[1])
+        return compressed
+
+
+# Turns the ORIGIN setting ("https://a.com,https://*.b.com") into a set of
+# exact origins plus one compiled pattern for wildcard entries
+def compile_origins(origins):
+    if not origins:
+        return frozenset(), None
+    if isinstance(origins, str):
+        origins = origins.split(",")
+    exact, patterns = set(), []
+    for origin in origins:
+        origin = origin.strip().rstrip("/")
+        if not origin:
+            continue
+        if "*" in origin and origin != "*":
+            patterns.append(re.escape(origin).replace(r"\*", r"[^./]+"))
+        else:
+            exact.add(origin)
+    pattern = re.compile("|".join(patterns)) if patterns else None
+    return frozenset(exact), pattern
+
+
+# Pure ASGI CORS middleware. Origins are matched against a precompiled set,
+# response headers are built once, and preflights carry Access-Control-Max-Age
+# so browsers stop repeating them for every call.
+class CORSMiddleware:
+    def __init__(self, app, allow_origins="", allow_credentials: bool = False, allow_methods=("*",), allow_headers=("*",), expose_headers=(), max_age: int = 600):
+        self.app = app
+        self.origins, self.origin_pattern = compile_origins(allow_origins)
+        self.allow_all = "*" in self.origins
+        self.allow_credentials = allow_credentials
+        self.allow_all_headers = "*" in allow_headers
+        if "*" in allow_methods:
+            allow_methods = ("DELETE", "GET", "HEAD", "OPTIONS", "PATCH", "POST", "PUT")
+        self.allowed_headers = frozenset(header.lower() for header in allow_headers)
+
+        simple = []
+        if allow_credentials:
+            simple.append((b"access-control-allow-credentials", b"true"))
+        if expose_headers:
+            simple.append((b"access-control-expose-headers", ", ".join(expose_headers).encode()))
+        self.simple_headers = simple
+        self.preflight_headers = simple + [
+            (b"access-control-allow-methods", ", ".join(allow_methods).encode()),
+            (b"access-control-max-age", str(max_age).encode()),
+        ]
+
+    def is_allowed_origin(self, origin: str):
+        if self.allow_all or origin in self.origins:
+            return True
+        return self.origin_pattern is not None and self.origin_pattern.fullmatch(origin) is not None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        origin = headers.get("origin")
+        if origin is None:
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] == "OPTIONS" and "access-control-request-method" in headers:
+            await self.preflight(origin, headers, send)
+            return
+        if not self.is_allowed_origin(origin):
+            await self.app(scope, receive, send)
+            return
+
+        origin_header = (b"access-control-allow-origin", origin.encode("latin-1"))
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response_headers = MutableHeaders(scope=message)
+                response_headers.raw.append(origin_header)
+                response_headers.raw.extend(self.simple_headers)
+                response_headers.add_vary_header("Origin")
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def preflight(self, origin, headers, send):
+        requested_headers = headers.get("access-control-request-headers", "")
+        allowed = self.is_allowed_origin(origin)
+        if allowed and requested_headers and not self.allow_all_headers:
+            allowed = all(
+                header.strip().lower() in self.allowed_headers
+                for header in requested_headers.split(",") if header.strip()
+            )
+        if not allowed:
+            body = b"Disallowed CORS request"
+            await send({"type": "http.response.start", "status": 400, "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+                (b"vary", b"Origin"),
+            ]})
+            await send({"type": "http.response.body", "body": body})
+            return
+        response_headers = [
+            (b"access-control-allow-origin", origin.encode("latin-1")),
+            (b"vary", b"Origin"),
+            (b"content-length", b"0"),
+        ] + self.preflight_headers
+        if requested_headers:
+            response_headers.append((b"access-control-allow-headers", requested_headers.encode("latin-1")))
+        await send({"type": "http.response.start", "status": 200, "headers": response_headers})
+        await send({"type": "http.response.body", "body": b""})
+
+
+# Pure ASGI middleware that makes POSTs to the given paths safe to retry.
+# A request with an Idempotency-Key header is stored with a hash of its body
+# and its response; a retry with the same key (per path and Authorization)
+# gets the stored response without running the route again. Entries expire
+# after ttl seconds and the oldest are dropped beyond max_entries or once
+# the stored responses take more than max_bytes. 5xx and streamed responses
+# and responses over max_body bytes are not stored; requests whose body
+# grows past max_body are passed through without idempotency.
+class IdempotencyMiddleware:
+    def __init__(self, app, paths=(), ttl: float = 86400.0, max_entries: int = 10_000, max_bytes: int = 16 << 20, max_body: int = 65536):
+        self.app = app
+        self.paths = frozenset(paths)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_body = max_body
+        self.entries = OrderedDict()
+        self.size = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        key = headers.get("idempotency-key")
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+
+        parts = []
+        received = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                await self.app(scope, receive, send)
+                return
+            parts.append(message.get("body", b""))
+            received += len(parts[-1])
+            more_body = message.get("more_body", False)
+            if received > self.max_body:
+                await self.app(scope, self.replay(b"".join(parts), more_body, receive), send)
+                return
+        body = b"".join(parts)
+        store_key = hashlib.blake2b(
+            "\n".join((scope["path"], headers.get("authorization", ""), key)).encode(), digest_size=16
+        ).digest()
+        request_hash = hashlib.blake2b(body, digest_size=16).digest()
+
+        now = time.monotonic()
+        entry = self.entries.get(store_key)
+        if entry is not None and entry[0] <= now:
+            self.discard(store_key)
+            entry = None
+        if entry is not None:
+            _, stored_hash, response, _ = entry
+            if stored_hash != request_hash:
+                await self.reject(send, 422, "Idempotency-Key was used with a different request")
+            elif response is None:
+                await self.reject(send, 409, "A request with this Idempotency-Key is in progress")
+            else:
+                status_code, raw_headers, response_body = response
+                await send({"type": "http.response.start", "status": status_code, "headers": raw_headers + [(b"idempotent-replayed", b"true")]})
+                await send({"type": "http.response.body", "body": response_body})
+            return
+
+        # Reserve the key so a concurrent retry gets 409 instead of a second run
+        self.store(store_key, now + self.ttl, request_hash, None)
+        start_message = None
+        chunks = []
+        storable = True
+
+        async def send_wrapper(message):
+            nonlocal start_message, storable
+            if message["type"] == "http.response.start":
+                # Copied now: outer middlewares add their headers in place
+                start_message = {**message, "headers": list(message["headers"])}
+                storable = message["status"] < 500
+            elif message["type"] == "http.response.body" and storable:
+                chunks.append(message.get("body", b""))
+                storable = not message.get("more_body", False) and sum(map(len, chunks)) <= self.max_body
+            await send(message)
+
+        try:
+            await self.app(scope, self.replay(body, False, receive), send_wrapper)
+        finally:
+            if start_message is not None and storable:
+                response = (start_message["status"], start_message["headers"], b"".join(chunks))
+                self.store(store_key, time.monotonic() + self.ttl, request_hash, response)
+            else:
+                self.discard(store_key)
+
+    # A receive that hands the app the body already read, then the rest
+    @staticmethod
+    def replay(body, more_body, receive):
+        replayed = False
+
+        async def replay_receive():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": more_body}
+            return await receive()
+        return replay_receive
+
+    # Entries are kept in expiry order, so expired ones are at the front.
+    # size counts response bodies and headers, the bulk of an entry.
+    def store(self, store_key, expires, request_hash, response):
+        self.discard(store_key)
+        size = 0 if response is None else len(response[2]) + sum(len(name) + len(value) for name, value in response[1])
+        self.entries[store_key] = (expires, request_hash, response, size)
+        self.size += size
+        now = time.monotonic()
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes or next(iter(self.entries.values()))[0] <= now):
+            self.size -= self.entries.popitem(last=False)[1][3]
+
+    def discard(self, store_key):
+        entry = self.entries.pop(store_key, None)
+        if entry is not None:
+            self.size -= entry[3]
+
+    async def reject(self, send, status_code, detail):
+        body = json.dumps({"detail": detail}).encode()
+        await send({"type": "http.response.start", "status": status_code, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ]})
+        await send({"type": "http.response.body", "body": body})
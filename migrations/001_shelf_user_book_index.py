@@ -0,0 +1,30 @@
+# Adds the unique (userId, bookKey) index to every shelf table and creates
+# shelf tables that do not exist yet (books_reading). Duplicate rows, which
+# the old add routes could create under concurrent requests, are removed
+# first, keeping the oldest.
+from sqlalchemy import inspect, text
+from common import create_shelf_tables, models, shelf_engines
+
+
+def migrate(engine):
+    create_shelf_tables(engine)
+    for table in models.shelf_tables():
+        # Tables already moved to bookId by 002 carry the new index
+        if "bookKey" not in {column["name"] for column in inspect(engine).get_columns(table.name)}:
+            continue
+        index_name = f"ix_{table.name}_user_book"
+        existing = {found["name"] for found in inspect(engine).get_indexes(table.name)}
+        if index_name in existing:
+            continue
+        with engine.begin() as connection:
+            removed = connection.execute(text(
+                f"DELETE FROM {table.name} WHERE id NOT IN ("
+                f"SELECT keep_id FROM (SELECT MIN(id) AS keep_id FROM {table.name} GROUP BY userId, bookKey) AS keep)"
+            )).rowcount
+            connection.execute(text(f"CREATE UNIQUE INDEX {index_name} ON {table.name} (userId, bookKey)"))
+        print(f"{engine.url.render_as_string()}: {table.name}: removed {removed} duplicates, created {index_name}")
+
+
+if __name__ == "__main__":
+    for shelf_engine in shelf_engines():
+        migrate(shelf_engine)
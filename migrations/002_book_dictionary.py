@@ -0,0 +1,65 @@
+# Moves shelf rows from a bookKey string to a bookId pointing at the books
+# dictionary: creates books, fills it with every key in use, sets bookId,
+# rebuilds the unique index on (userId, bookId) and drops bookKey. Prints
+# table and index sizes before and after.
+#
+# SQLite cannot change a column to NOT NULL in place, so bookId stays
+# nullable there; on MySQL it is made NOT NULL (with a foreign key to books
+# on the primary).
+from sqlalchemy import inspect, text
+from common import create_shelf_tables, engine, models, print_sizes, shelf_engines, table_sizes
+
+
+def migrate(shelf_engine):
+    create_shelf_tables(shelf_engine)
+    tables = [table for table in models.shelf_tables()
+              if "bookKey" in {column["name"] for column in inspect(shelf_engine).get_columns(table.name)}]
+    if not tables:
+        return
+    names = [table.name for table in tables] + ["books"]
+    print_sizes(shelf_engine, "before", table_sizes(shelf_engine, names))
+
+    for table in tables:
+        index = next(index for index in table.indexes if index.name == f"ix_{table.name}_user_book")
+        with shelf_engine.begin() as connection:
+            mysql = connection.dialect.name == "mysql"
+            columns = {column["name"] for column in inspect(connection).get_columns(table.name)}
+            if "bookId" not in columns:
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN bookId INTEGER NULL"))
+            added = connection.execute(text(
+                f"INSERT INTO books (bookKey) SELECT DISTINCT t.bookKey FROM {table.name} t "
+                f"WHERE NOT EXISTS (SELECT 1 FROM books b WHERE b.bookKey = t.bookKey)"
+            )).rowcount
+            connection.execute(text(
+                f"UPDATE {table.name} SET bookId = (SELECT id FROM books WHERE books.bookKey = {table.name}.bookKey)"
+            ))
+            indexed = {found["name"]: found["column_names"] for found in inspect(connection).get_indexes(table.name)}
+            if index.name not in indexed:
+                index.create(connection)
+            elif "bookKey" in indexed[index.name] and mysql:
+                # One statement, so the userId foreign key is never left without an index
+                connection.execute(text(
+                    f"ALTER TABLE {table.name} DROP INDEX {index.name}, ADD UNIQUE INDEX {index.name} (userId, bookId)"
+                ))
+            elif "bookKey" in indexed[index.name]:
+                connection.execute(text(f"DROP INDEX {index.name}"))
+                index.create(connection)
+            if mysql:
+                connection.execute(text(f"ALTER TABLE {table.name} MODIFY bookId INTEGER NOT NULL"))
+                foreign_keys = {found["name"] for found in inspect(connection).get_foreign_keys(table.name)}
+                if shelf_engine is engine and f"fk_{table.name}_book" not in foreign_keys:
+                    connection.execute(text(
+                        f"ALTER TABLE {table.name} ADD CONSTRAINT fk_{table.name}_book FOREIGN KEY (bookId) REFERENCES books (id)"
+                    ))
+            connection.execute(text(f"ALTER TABLE {table.name} DROP COLUMN bookKey"))
+        print(f"{shelf_engine.url.render_as_string()}: {table.name}: {added} new dictionary keys, bookKey replaced by bookId")
+
+    if shelf_engine.dialect.name == "sqlite":
+        with shelf_engine.connect() as connection:
+            connection.execute(text("VACUUM"))
+    print_sizes(shelf_engine, "after", table_sizes(shelf_engine, names))
+
+
+if __name__ == "__main__":
+    for shelf_engine in shelf_engines():
+        migrate(shelf_engine)
@@ -0,0 +1,36 @@
+# Rebuilds each shelf table's primary key to match SHELF_CLUSTERED_BY_USER:
+# (userId, id) when it is 1, id otherwise, so the setting can be turned on
+# and back off. InnoDB rebuilds the table in place and keeps accepting
+# writes while it does. Prints table and index sizes before and after.
+#
+# MySQL only: SQLite cannot change a primary key in place (and the
+# clustered layout is not supported there).
+from sqlalchemy import inspect, text
+from common import models, print_sizes, shelf_engines, table_sizes
+from database import SHELF_CLUSTERED_BY_USER
+
+PRIMARY_KEY = ["userId", "id"] if SHELF_CLUSTERED_BY_USER else ["id"]
+
+
+def migrate(shelf_engine):
+    if shelf_engine.dialect.name != "mysql":
+        print(f"{shelf_engine.url.render_as_string()}: skipped, primary key changes need MySQL")
+        return
+    tables = [table.name for table in models.shelf_tables()
+              if inspect(shelf_engine).get_pk_constraint(table.name)["constrained_columns"] != PRIMARY_KEY]
+    if not tables:
+        return
+    print_sizes(shelf_engine, "before", table_sizes(shelf_engine, tables))
+    for name in tables:
+        columns = ", ".join(PRIMARY_KEY)
+        with shelf_engine.begin() as connection:
+            connection.execute(text(
+                f"ALTER TABLE {name} DROP PRIMARY KEY, ADD PRIMARY KEY ({columns}), ALGORITHM=INPLACE, LOCK=NONE"
+            ))
+        print(f"{shelf_engine.url.render_as_string()}: {name}: primary key is now ({columns})")
+    print_sizes(shelf_engine, "after", table_sizes(shelf_engine, tables))
+
+
+if __name__ == "__main__":
+    for shelf_engine in shelf_engines():
+        migrate(shelf_engine)
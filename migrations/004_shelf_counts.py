@@ -0,0 +1,15 @@
+# Creates the shelf_counts table and fills it from the existing shelf rows.
+# Safe while the app is running: counters the app creates in the meantime
+# are left alone unless they disagree with the rows.
+from common import create_shelf_tables, shelf_engines
+from reconcile_counts import reconcile
+
+
+def migrate(shelf_engine):
+    create_shelf_tables(shelf_engine)
+    print(f"{shelf_engine.url.render_as_string()}: filled {reconcile(shelf_engine)} counters")
+
+
+if __name__ == "__main__":
+    for shelf_engine in shelf_engines():
+        migrate(shelf_engine)
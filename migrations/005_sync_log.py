@@ -0,0 +1,10 @@
+# Creates the user_versions and shelf_changes tables behind
+# /library/{user_id}/changes. Changes made before this migration are not in
+# the log: clients start from the X-Sync-Version of a full /library fetch.
+from common import create_shelf_tables, shelf_engines
+
+
+if __name__ == "__main__":
+    for shelf_engine in shelf_engines():
+        create_shelf_tables(shelf_engine)
+        print(f"{shelf_engine.url.render_as_string()}: created the sync log tables")
@@ -0,0 +1,31 @@
+# Adds the position column of ordered shelves (to-read): fills it with
+# id * POSITION_GAP, so every shelf keeps its current id order, then adds
+# the unique (userId, position) index. Run it during the deploy that ships
+# the column, while shelf writes are paused: rows the old code adds after
+# the index exists would all get position 0.
+from sqlalchemy import inspect, text
+from common import create_shelf_tables, models, shelf_engines
+from shelves import POSITION_GAP
+
+
+def migrate(shelf_engine):
+    create_shelf_tables(shelf_engine)
+    for table in models.shelf_tables():
+        if "position" not in table.c:
+            continue
+        index = next(index for index in table.indexes if "position" in index.columns)
+        with shelf_engine.begin() as connection:
+            columns = {column["name"] for column in inspect(connection).get_columns(table.name)}
+            if "position" not in columns:
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN position BIGINT NOT NULL DEFAULT 0"))
+            filled = connection.execute(text(f"UPDATE {table.name} SET position = id * {POSITION_GAP} WHERE position = 0")).rowcount
+            if index.name not in {found["name"] for found in inspect(connection).get_indexes(table.name)}:
+                index.create(connection)
+            if connection.dialect.name == "mysql":
+                connection.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN position DROP DEFAULT"))
+        print(f"{shelf_engine.url.render_as_string()}: {table.name}: positions set for {filled} rows")
+
+
+if __name__ == "__main__":
+    for shelf_engine in shelf_engines():
+        migrate(shelf_engine)
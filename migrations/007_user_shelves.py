@@ -0,0 +1,9 @@
+# Creates the user_shelves and user_shelf_books tables behind the
+# user-created shelf routes.
+from common import create_shelf_tables, shelf_engines
+
+
+if __name__ == "__main__":
+    for shelf_engine in shelf_engines():
+        create_shelf_tables(shelf_engine)
+        print(f"{shelf_engine.url.render_as_string()}: created the user shelf tables")
@@ -0,0 +1,21 @@
+# Adds the moved and position columns of shelf_changes, so reorders on
+# ordered shelves (to-read) reach /library/{user_id}/changes and /events.
+# Changes logged before this migration carry no position.
+from sqlalchemy import inspect, text
+from common import create_shelf_tables, shelf_engines
+
+
+def migrate(shelf_engine):
+    create_shelf_tables(shelf_engine)
+    with shelf_engine.begin() as connection:
+        columns = {column["name"] for column in inspect(connection).get_columns("shelf_changes")}
+        if "moved" not in columns:
+            connection.execute(text("ALTER TABLE shelf_changes ADD COLUMN moved BOOLEAN NOT NULL DEFAULT 0"))
+        if "position" not in columns:
+            connection.execute(text("ALTER TABLE shelf_changes ADD COLUMN position BIGINT NULL"))
+    print(f"{shelf_engine.url.render_as_string()}: shelf_changes can log reorders")
+
+
+if __name__ == "__main__":
+    for shelf_engine in shelf_engines():
+        migrate(shelf_engine)
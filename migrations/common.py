@@ -0,0 +1,51 @@
+# Shared setup for the migration scripts in this directory. Each script is
+# run directly (python migrations/<script>.py) and is safe to run again.
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import text
+import models
+from database import engine, shelf_engines
+from sharding import create_shard_tables
+
+
+# Creates missing shelf tables; shard copies carry no foreign keys
+def create_shelf_tables(shelf_engine):
+    if shelf_engine is engine:
+        models.Base.metadata.create_all(engine, tables=models.sharded_tables())
+    else:
+        create_shard_tables(shelf_engine, models.sharded_tables())
+
+
+# {table: (data bytes, index bytes)} for the given tables, or None when the
+# backend has no size statistics we can read
+def table_sizes(shelf_engine, names):
+    with shelf_engine.connect() as connection:
+        if connection.dialect.name == "mysql":
+            for name in names:
+                connection.execute(text(f"ANALYZE TABLE {name}"))
+            rows = connection.execute(text(
+                "SELECT TABLE_NAME, DATA_LENGTH, INDEX_LENGTH FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = DATABASE()"
+            ))
+            return {name: (data, index) for name, data, index in rows if name in names}
+        if connection.dialect.name == "sqlite":
+            sizes = {name: [0, 0] for name in names}
+            rows = connection.execute(text(
+                "SELECT m.tbl_name, m.type, SUM(s.pgsize) FROM dbstat s "
+                "JOIN sqlite_master m ON m.name = s.name GROUP BY m.tbl_name, m.type"
+            ))
+            for table, kind, size in rows:
+                if table in sizes:
+                    sizes[table][kind == "index"] += size
+            return {name: tuple(size) for name, size in sizes.items()}
+    return None
+
+
+def print_sizes(shelf_engine, label, sizes):
+    if sizes is None:
+        return
+    for name, (data, index) in sizes.items():
+        print(f"{shelf_engine.url.render_as_string()}: {label} {name}: data {data / 1024:.0f} KiB, indexes {index / 1024:.0f} KiB")
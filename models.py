@@ -1,8 +1,13 @@
-from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, DateTime,func
-from sqlalchemy.orm import relationship, validates
-from database import Base
+from datetime import datetime, timezone
+from sqlalchemy import BigInteger, Boolean, Column, Integer, String, ForeignKey, DateTime, Index, PrimaryKeyConstraint, func
+from sqlalchemy.orm import declared_attr, relationship, validates
+from database import Base, SHELF_CLUSTERED_BY_USER
 
 
+# The current UTC time without a zone, for columns read as UTC
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class Timestamp:
     created_at = Column(DateTime, default=func.now(), nullable=False)
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
@@ -14,24 +19,154 @@ class User(Base, Timestamp):
     name = Column(String(100), nullable=False)
     email = Column(String(100), unique=True, nullable=False)
     password = Column(String(125), nullable=False)
-    # Creates relationships with BooksToRead and BooksRead
+    # Creates relationships with the shelf tables
     books_to_read = relationship("BooksToRead", back_populates="user")
     books_read = relationship("BooksRead", back_populates="user")
+    books_reading = relationship("BooksReading", back_populates="user")
 
-class BooksToRead(Base, Timestamp):
-    __tablename__ = "books_to_read"
+# Open Library keys stored once; shelf rows point at them by integer id.
+# Each shard keeps its own dictionary.
+class Book(Base):
+    __tablename__ = "books"
+    sharded = True
 
-    id = Column(Integer, primary_key=True, index=True)
-    bookKey = Column(String(100), nullable=False)
-    userId = Column(Integer, ForeignKey('users.id'), nullable=False)
+    id = Column(Integer, primary_key=True)
+    bookKey = Column(String(100), unique=True, nullable=False)
+
+# Columns shared by every shelf table. The unique (userId, bookId) index
+# backs listing by user, membership lookups and duplicate checks.
+# sharded: stored on the user's shard when URL_DATABASE_SHARDS is set.
+# With SHELF_CLUSTERED_BY_USER the primary key is (userId, id); the id index
+# keeps id unique and satisfies InnoDB's AUTO_INCREMENT rule. Shelves with a
+# position column are kept in user-defined order; their unique
+# (userId, position) index (InnoDB appends the primary key) serves keyset
+# pages in that order.
+class ShelfEntry(Timestamp):
+    sharded = True
+
+    id = Column(Integer, primary_key=not SHELF_CLUSTERED_BY_USER, autoincrement=True, index=True)
+
+    @declared_attr
+    def bookId(cls):
+        return Column(Integer, ForeignKey('books.id'), nullable=False)
+
+    @declared_attr
+    def userId(cls):
+        return Column(Integer, ForeignKey('users.id'), nullable=False)
+
+    @declared_attr
+    def __table_args__(cls):
+        args = (Index(f"ix_{cls.__tablename__}_user_book", "userId", "bookId", unique=True),)
+        if "position" in cls.__dict__:
+            args += (Index(f"ix_{cls.__tablename__}_user_position", "userId", "position", unique=True),)
+        if SHELF_CLUSTERED_BY_USER:
+            args += (PrimaryKeyConstraint("userId", "id"),)
+        return args
+
+class BooksToRead(Base, ShelfEntry):
+    __tablename__ = "books_to_read"
+    # Sort key of the user's order, see shelves.reorder_book
+    position = Column(BigInteger, nullable=False)
     # Creates relationship with users
     user = relationship("User", back_populates="books_to_read")
 
-class BooksRead(Base, Timestamp):
+class BooksRead(Base, ShelfEntry):
     __tablename__ = "books_read"
+    # Creates relationship with users
+    user = relationship("User", back_populates="books_read")
 
-    id = Column(Integer, primary_key=True, index=True)
-    bookKey = Column(String(100), nullable=False)
-    userId = Column(Integer, ForeignKey('users.id'), nullable=False)
+class BooksReading(Base, ShelfEntry):
+    __tablename__ = "books_reading"
     # Creates relationship with users
-    user = relationship("User", back_populates="books_read")
\ No newline at end of file
+    user = relationship("User", back_populates="books_reading")
+
+# Number of books on each of a user's shelves (shelf is the table name),
+# changed in the same transaction as the shelf rows by shelves.add_books and
+# remove_books. reconcile_counts.py finds and repairs drift.
+class ShelfCount(Base):
+    __tablename__ = "shelf_counts"
+    sharded = True
+
+    userId = Column(Integer, primary_key=True, autoincrement=False)
+    shelf = Column(String(50), primary_key=True)
+    count = Column(Integer, default=0, nullable=False)
+
+# Per-user sync version. Every shelf write raises it by the number of
+# changes it logs in shelf_changes, so each change gets its own version and
+# a user's versions grow in commit order (the row lock serializes writers).
+# compacted_through is the newest version whose changes were dropped.
+class UserVersion(Base):
+    __tablename__ = "user_versions"
+    sharded = True
+
+    userId = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer, default=0, nullable=False)
+    compacted_through = Column(Integer, default=0, nullable=False)
+
+# A book added to (or, with removed set, taken off) a shelf, for ?since= sync.
+# moved marks a reorder on an ordered shelf; adds and reorders there carry
+# the book's new position. compact_changes.py drops old rows.
+class ShelfChange(Base):
+    __tablename__ = "shelf_changes"
+    sharded = True
+
+    id = Column(Integer, primary_key=True)
+    userId = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False)
+    shelf = Column(String(50), nullable=False)
+    bookId = Column(Integer, ForeignKey('books.id'), nullable=False)
+    removed = Column(Boolean, default=False, nullable=False)
+    moved = Column(Boolean, default=False, nullable=False)
+    position = Column(BigInteger, nullable=True)
+    # Naive UTC whatever the database time zone, since sync compares it with
+    # client clocks
+    created_at = Column(DateTime, default=utc_now, nullable=False)
+
+    __table_args__ = (Index("ix_shelf_changes_user_version", "userId", "version", unique=True),)
+
+# Shelves a user creates, on top of the built-in ones. book_count is kept in
+# the same transaction as user_shelf_books, so listing shelves with their
+# sizes never counts rows. The unique (userId, name) index lists a user's
+# shelves by name.
+class UserShelf(Base):
+    __tablename__ = "user_shelves"
+    sharded = True
+
+    id = Column(Integer, primary_key=True)
+    userId = Column(Integer, ForeignKey('users.id'), nullable=False)
+    name = Column(String(100), nullable=False)
+    book_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+
+    __table_args__ = (Index("ix_user_shelves_user_name", "userId", "name", unique=True),)
+
+# A book on a user-created shelf. The primary key (shelfId, bookId) serves
+# a shelf's books in bookId pages; (userId, bookId, shelfId) answers which
+# of a user's shelves hold a book from the index alone.
+class UserShelfBook(Base):
+    __tablename__ = "user_shelf_books"
+    sharded = True
+
+    shelfId = Column(Integer, ForeignKey('user_shelves.id'), primary_key=True, autoincrement=False)
+    bookId = Column(Integer, ForeignKey('books.id'), primary_key=True, autoincrement=False)
+    userId = Column(Integer, ForeignKey('users.id'), nullable=False)
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+
+    __table_args__ = (Index("ix_user_shelf_books_user_book", "userId", "bookId", "shelfId"),)
+
+# Users moved off their hash-ring shard, and users being moved (writes refused)
+class ShardDirectory(Base):
+    __tablename__ = "shard_directory"
+
+    userId = Column(Integer, primary_key=True, autoincrement=False)
+    shard = Column(Integer, nullable=False)
+    moving = Column(Boolean, default=False, nullable=False)
+
+
+# Tables that live on the user's shard (the book dictionary and shelf tables)
+def sharded_tables():
+    return [mapper.local_table for mapper in Base.registry.mappers if getattr(mapper.class_, "sharded", False)]
+
+# Per-user shelf tables (every ShelfEntry subclass)
+def shelf_tables():
+    return [mapper.local_table for mapper in Base.registry.mappers if issubclass(mapper.class_, ShelfEntry)]
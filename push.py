@@ -0,0 +1,148 @@
+import asyncio
+import json
+import os
+from fastapi import HTTPException
+from sqlalchemy import bindparam, select
+from starlette import status
+import models
+from database import commit_listeners, engine, shards
+
+VERSIONS_STATEMENT = select(models.UserVersion.userId, models.UserVersion.version).where(
+    models.UserVersion.userId.in_(bindparam("user_ids", expanding=True))
+)
+
+
+# One open event stream. Only the newest version not yet sent is kept, so a
+# burst of writes costs one event and a connection's memory stays constant
+# however slowly its client reads.
+class Subscription:
+    def __init__(self, user_id: int, version: int):
+        self.user_id = user_id
+        self.version = version
+        self.pending = None
+        self.ready = asyncio.Event()
+
+    def publish(self, version: int):
+        if version > (self.version if self.pending is None else self.pending):
+            self.pending = version
+            self.ready.set()
+
+    # The next version to send, or None after timeout seconds without one
+    async def next(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self.ready.clear()
+        self.version, self.pending = self.pending, None
+        return self.version
+
+
+# Fans shelf changes out to the open event streams of this process. Commits
+# made here wake the poller at once through commit_listeners; every
+# poll_interval it also reads the versions of all connected users, one query
+# per shard, which picks up writes served by other processes.
+class ChangeBroker:
+    def __init__(self, max_connections: int = 10_000, max_per_user: int = 5, poll_interval: float = 5.0, keepalive: float = 25.0):
+        self.max_connections = max_connections
+        self.max_per_user = max_per_user
+        self.poll_interval = poll_interval
+        self.keepalive = keepalive
+        self.subscribers = {}
+        self.connections = 0
+        self.dirty = set()
+        self.loop = None
+        self.wake = None
+
+    def subscribe(self, user_id: int, version: int | None = None):
+        streams = self.subscribers.get(user_id, ())
+        if self.connections >= self.max_connections or len(streams) >= self.max_per_user:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many open event streams",
+                headers={"Retry-After": str(int(self.poll_interval) * 2 + 1)}
+            )
+        subscription = Subscription(user_id, -1 if version is None else version)
+        self.subscribers.setdefault(user_id, set()).add(subscription)
+        self.connections += 1
+        # The first event tells a new stream the current version
+        self.mark(user_id)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        streams = self.subscribers.get(subscription.user_id)
+        if streams is not None and subscription in streams:
+            streams.remove(subscription)
+            self.connections -= 1
+            if not streams:
+                del self.subscribers[subscription.user_id]
+
+    def mark(self, user_id: int):
+        if user_id in self.subscribers:
+            self.dirty.add(user_id)
+            if self.wake is not None:
+                self.wake.set()
+
+    # Commit listener; commits may run outside the event loop thread
+    def notify(self, user_id: int):
+        if self.loop is not None and user_id in self.subscribers:
+            self.loop.call_soon_threadsafe(self.mark, user_id)
+
+    def publish(self, versions):
+        for user_id, version in versions.items():
+            for subscription in self.subscribers.get(user_id, ()):
+                subscription.publish(version)
+
+    # Runs from the app lifespan
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                self.dirty.update(self.subscribers)
+            self.wake.clear()
+            user_ids, self.dirty = list(self.dirty), set()
+            if user_ids:
+                try:
+                    self.publish(await asyncio.to_thread(load_versions, user_ids))
+                except Exception:
+                    self.dirty.update(user_ids)
+
+    # Server-sent events for one subscription until the client goes away
+    async def stream(self, request, subscription: Subscription):
+        try:
+            yield f"retry: {int(self.poll_interval * 1000)}\n\n"
+            while not await request.is_disconnected():
+                version = await subscription.next(self.keepalive)
+                if version is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield f"id: {version}\nevent: changes\ndata: {json.dumps({'version': version})}\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+
+# {userId: version}, 0 for users without changes yet. Read from the primary
+# (or their shard) so events are not held back by replica lag.
+def load_versions(user_ids):
+    by_engine = {}
+    for user_id in user_ids:
+        target = shards.engine_for(user_id) if shards else engine
+        by_engine.setdefault(target, []).append(user_id)
+    versions = dict.fromkeys(user_ids, 0)
+    for target, users in by_engine.items():
+        with target.connect() as connection:
+            for start in range(0, len(users), 1000):
+                versions.update(connection.execute(VERSIONS_STATEMENT, {"user_ids": users[start:start + 1000]}).all())
+    return versions
+
+
+change_broker = ChangeBroker(
+    max_connections=int(os.getenv("PUSH_MAX_CONNECTIONS", "10000")),
+    max_per_user=int(os.getenv("PUSH_MAX_PER_USER", "5")),
+    poll_interval=float(os.getenv("PUSH_POLL_INTERVAL", "5")),
+    keepalive=float(os.getenv("PUSH_KEEPALIVE", "25"))
+)
+commit_listeners.append(change_broker.notify)
@@ -0,0 +1,58 @@
+# Compares the shelf_counts counters with the shelf tables and repairs any
+# drift (for example rows changed outside the app or restored from a
+# backup). Run it from cron; migrations/004_shelf_counts.py uses it to fill
+# the counters the first time.
+#
+#   python reconcile_counts.py [--dry-run]
+#
+# Each repair locks the counter row before recounting, so adds and deletes
+# that commit meanwhile are counted once: either in the recount or by their
+# own increment after the lock is released.
+import argparse
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.exc import IntegrityError
+import models
+from database import shelf_engines
+from shelves import SHELVES
+
+Count = models.ShelfCount.__table__
+
+
+def repair(shelf_engine, table, user_id: int):
+    try:
+        with shelf_engine.begin() as connection:
+            where = (Count.c.userId == user_id, Count.c.shelf == table.name)
+            connection.execute(select(Count.c.count).where(*where).with_for_update())
+            actual = connection.scalar(select(func.count()).select_from(table).where(table.c.userId == user_id))
+            connection.execute(delete(Count).where(*where))
+            connection.execute(insert(Count), {"userId": user_id, "shelf": table.name, "count": actual})
+        return actual
+    except IntegrityError:
+        # A first add for this user created the counter row concurrently
+        return None
+
+
+def reconcile(shelf_engine, dry_run: bool = False):
+    repaired = 0
+    for shelf in SHELVES.values():
+        table = shelf.model.__table__
+        with shelf_engine.connect() as connection:
+            actual = dict(connection.execute(select(table.c.userId, func.count()).group_by(table.c.userId)).all())
+            stored = dict(connection.execute(select(Count.c.userId, Count.c.count).where(Count.c.shelf == table.name)).all())
+        for user_id in sorted(set(actual) | set(stored)):
+            if actual.get(user_id, 0) == stored.get(user_id, 0):
+                continue
+            print(f"{shelf_engine.url.render_as_string()}: {table.name} user {user_id}: counter {stored.get(user_id)}, rows {actual.get(user_id, 0)}")
+            if not dry_run:
+                fixed = repair(shelf_engine, table, user_id)
+                print(f"    {'set to ' + str(fixed) if fixed is not None else 'changed concurrently, run again'}")
+                repaired += fixed is not None
+    return repaired
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Repair drift between shelf_counts and the shelf tables")
+    parser.add_argument("--dry-run", action="store_true", help="only report drift")
+    args = parser.parse_args()
+    total = sum(reconcile(shelf_engine, args.dry_run) for shelf_engine in shelf_engines())
+    print(f"repaired {total} counters")
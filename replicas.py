@@ -0,0 +1,73 @@
+import itertools
+import logging
+import threading
+import time
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger("database")
+
+
+# Routes reads across replica engines round-robin. A user who wrote within
+# lag_window seconds reads from the primary so they see their own writes.
+# Replicas that fail a connection or health check are skipped until a later
+# check finds them healthy again; with no healthy replica reads go to the primary.
+class ReplicaSet:
+    def __init__(self, engines, lag_window: float = 5.0, retry_interval: float = 10.0, max_tracked_users: int = 100_000):
+        self.engines = list(engines)
+        self.lag_window = lag_window
+        self.retry_interval = retry_interval
+        self.max_tracked_users = max_tracked_users
+        self.down_until = [0.0] * len(self.engines)
+        self.last_write = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.engines)
+
+    # Called after a commit that changed a user's data
+    def record_write(self, user_id: int):
+        now = time.monotonic()
+        with self.lock:
+            if len(self.last_write) >= self.max_tracked_users:
+                cutoff = now - self.lag_window
+                self.last_write = {user: at for user, at in self.last_write.items() if at > cutoff}
+            self.last_write[user_id] = now
+
+    def must_read_primary(self, user_id: int | None):
+        if user_id is None:
+            return False
+        written_at = self.last_write.get(user_id)
+        return written_at is not None and time.monotonic() - written_at < self.lag_window
+
+    def mark_down(self, index: int):
+        self.down_until[index] = time.monotonic() + self.retry_interval
+        logger.warning("replica %d marked down for %.0fs", index, self.retry_interval)
+
+    # Returns an open connection to a healthy replica, or None to use the primary
+    def connect(self, user_id: int | None = None):
+        if not self.engines or self.must_read_primary(user_id):
+            return None
+        now = time.monotonic()
+        start = next(self.counter)
+        for offset in range(len(self.engines)):
+            index = (start + offset) % len(self.engines)
+            if self.down_until[index] > now:
+                continue
+            try:
+                return self.engines[index].connect()
+            except DBAPIError:
+                self.mark_down(index)
+        return None
+
+    # Pings every replica; run periodically from the app lifespan
+    def check_health(self):
+        for index, engine in enumerate(self.engines):
+            try:
+                with engine.connect() as connection:
+                    connection.execute(text("SELECT 1"))
+            except DBAPIError:
+                self.mark_down(index)
+            else:
+                self.down_until[index] = 0.0
@@ -0,0 +1,143 @@
+# Moves users between shelf shards while the app keeps serving.
+#
+#   python reshard.py move USER_ID SHARD
+#       Move one user's shelf rows to SHARD.
+#   python reshard.py pin --from-count N
+#       Before adding shards: pin every user whose ring shard changes to the
+#       shard they are on under the old N-shard ring. Run with the new
+#       URL_DATABASE_SHARDS, then deploy the app with it.
+#   python reshard.py rebalance
+#       Move every pinned user to their ring shard and drop their pin.
+#
+# A move marks the user as moving (their writes get 503), waits for every
+# process to reload the shard directory, copies the rows, points the user at
+# the new shard, waits again, then deletes the old rows. Row ids are assigned
+# by the target shard, and bookIds are translated to the target shard's book
+# dictionary. User-created shelves are copied before their books, whose
+# shelfIds are translated through the shelf names.
+import argparse
+import time
+from sqlalchemy import delete, insert, select
+import models
+from books import create_ids
+from database import SessionLocal, engine, shards
+from sharding import HashRing
+
+# Tables with a shelfId go after user_shelves, which assigns their new ids
+TABLES = sorted((table for table in models.sharded_tables() if "userId" in table.c), key=lambda table: "shelfId" in table.c)
+Book = models.Book.__table__
+UserShelf = models.UserShelf.__table__
+Directory = models.ShardDirectory
+
+
+def set_entry(user_id: int, shard: int | None, moving: bool = False):
+    with SessionLocal(bind=engine) as db:
+        db.execute(delete(Directory).where(Directory.userId == user_id))
+        if shard is not None:
+            db.add(Directory(userId=user_id, shard=shard, moving=moving))
+        db.commit()
+
+
+def wait_for_directory_reload():
+    time.sleep(shards.directory_ttl + 1)
+
+
+def current_shard(user_id: int):
+    entry = shards.load_directory().get(user_id)
+    return entry[0] if entry else shards.ring.shard_for(user_id)
+
+
+# A user's rows of one table; shelf rows carry their bookKey so the bookId
+# can be translated
+def rows_statement(table, user_id: int):
+    if "bookId" not in table.c:
+        return select(table).where(table.c.userId == user_id)
+    return select(table, Book.c.bookKey).join(Book, Book.c.id == table.c.bookId).where(table.c.userId == user_id)
+
+
+def move(user_id: int, target: int):
+    source = current_shard(user_id)
+    if source == target:
+        print(f"user {user_id} is already on shard {target}")
+        return
+    set_entry(user_id, source, moving=True)
+    wait_for_directory_reload()
+
+    with shards.engine(source).connect() as source_db, shards.engine(target).begin() as target_db:
+        shelf_names = dict(source_db.execute(select(UserShelf.c.id, UserShelf.c.name).where(UserShelf.c.userId == user_id)).all())
+        shelf_ids = {}
+        for table in TABLES:
+            rows = [
+                {column: value for column, value in row._mapping.items() if column != "id"}
+                for row in source_db.execute(rows_statement(table, user_id))
+            ]
+            target_db.execute(delete(table).where(table.c.userId == user_id))
+            if rows and "bookId" in table.c:
+                book_ids = create_ids(target_db, dict.fromkeys(row["bookKey"] for row in rows))
+                for row in rows:
+                    row["bookId"] = book_ids[row.pop("bookKey")]
+            if rows and "shelfId" in table.c:
+                for row in rows:
+                    row["shelfId"] = shelf_ids[shelf_names[row["shelfId"]]]
+            if rows:
+                target_db.execute(insert(table), rows)
+            if table is UserShelf:
+                shelf_ids = dict(target_db.execute(select(UserShelf.c.name, UserShelf.c.id).where(UserShelf.c.userId == user_id)).all())
+            print(f"user {user_id}: copied {len(rows)} rows of {table.name} from shard {source} to {target}")
+
+    # The ring already points at target: the pin is no longer needed
+    pinned = None if shards.ring.shard_for(user_id) == target else target
+    set_entry(user_id, target, moving=True)
+    wait_for_directory_reload()
+    set_entry(user_id, pinned)
+
+    with shards.engine(source).begin() as source_db:
+        for table in TABLES:
+            source_db.execute(delete(table).where(table.c.userId == user_id))
+    print(f"user {user_id}: now on shard {target}")
+
+
+def pin(from_count: int):
+    old_ring = HashRing(from_count)
+    directory = shards.load_directory()
+    with SessionLocal(bind=engine) as db:
+        user_ids = db.scalars(select(models.User.id)).all()
+    pinned = 0
+    for user_id in user_ids:
+        old_shard = old_ring.shard_for(user_id)
+        if user_id not in directory and shards.ring.shard_for(user_id) != old_shard:
+            set_entry(user_id, old_shard)
+            pinned += 1
+    print(f"pinned {pinned} users to their current shard")
+
+
+def rebalance():
+    for user_id, (shard, moving) in shards.load_directory().items():
+        target = shards.ring.shard_for(user_id)
+        if moving:
+            print(f"user {user_id} is mid-move, skipping")
+        elif shard != target:
+            move(user_id, target)
+        else:
+            set_entry(user_id, None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move users between shelf shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    move_parser = commands.add_parser("move")
+    move_parser.add_argument("user_id", type=int)
+    move_parser.add_argument("shard", type=int)
+    pin_parser = commands.add_parser("pin")
+    pin_parser.add_argument("--from-count", type=int, required=True)
+    commands.add_parser("rebalance")
+    args = parser.parse_args()
+
+    if not shards:
+        parser.error("URL_DATABASE_SHARDS is not set")
+    if args.command == "move":
+        move(args.user_id, args.shard)
+    elif args.command == "pin":
+        pin(args.from_count)
+    else:
+        rebalance()
@@ -0,0 +1,93 @@
+import bisect
+import hashlib
+import threading
+import time
+from fastapi import HTTPException
+from sqlalchemy import ForeignKeyConstraint, MetaData, text
+from starlette import status
+
+
+def hash64(value: str):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+# Consistent-hash ring over shard indexes; adding a shard only remaps the
+# users whose points now fall on the new shard
+class HashRing:
+    def __init__(self, shard_count: int, vnodes: int = 64):
+        points = sorted((hash64(f"shard-{index}-{vnode}"), index) for index in range(shard_count) for vnode in range(vnodes))
+        self.keys = [point for point, _ in points]
+        self.shards = [index for _, index in points]
+
+    def shard_for(self, user_id: int):
+        position = bisect.bisect(self.keys, hash64(str(user_id))) % len(self.keys)
+        return self.shards[position]
+
+
+# Maps a userId to one of the shard engines. The shard_directory table on the
+# primary overrides the ring for users that have been moved, and marks users
+# that are being moved so their writes are refused until the move finishes.
+# The directory is reloaded at most every directory_ttl seconds.
+class ShardMap:
+    def __init__(self, urls, engine_factory, directory_engine=None, directory_ttl: float = 5.0):
+        self.urls = list(urls)
+        self.engine_factory = engine_factory
+        self.directory_engine = directory_engine
+        self.directory_ttl = directory_ttl
+        self.ring = HashRing(len(self.urls)) if self.urls else None
+        self.engines = {}
+        self.directory = {}
+        self.loaded_at = float("-inf")
+        self.lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.urls)
+
+    def engine(self, index: int, isolation_level: str | None = None):
+        key = (index, isolation_level)
+        if key not in self.engines:
+            self.engines.setdefault(key, self.engine_factory(self.urls[index], isolation_level))
+        return self.engines[key]
+
+    def load_directory(self):
+        with self.directory_engine.connect() as connection:
+            rows = connection.execute(text("SELECT userId, shard, moving FROM shard_directory"))
+            return {user_id: (shard, bool(moving)) for user_id, shard, moving in rows}
+
+    def lookup(self, user_id: int):
+        if self.directory_engine is not None and time.monotonic() - self.loaded_at > self.directory_ttl:
+            with self.lock:
+                if time.monotonic() - self.loaded_at > self.directory_ttl:
+                    self.directory = self.load_directory()
+                    self.loaded_at = time.monotonic()
+        entry = self.directory.get(user_id)
+        if entry is None:
+            return self.ring.shard_for(user_id), False
+        return entry
+
+    def engine_for(self, user_id: int, isolation_level: str | None = None):
+        index, _ = self.lookup(user_id)
+        return self.engine(index, isolation_level)
+
+    def check_writable(self, user_id: int):
+        _, moving = self.lookup(user_id)
+        if moving:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="This library is being moved, try again shortly",
+                headers={"Retry-After": str(int(self.directory_ttl) * 2 + 1)}
+            )
+
+
+# Creates the sharded tables on a shard. Shards hold no users table, so the
+# copies are made without their foreign keys.
+def create_shard_tables(engine, tables):
+    metadata = MetaData()
+    for table in tables:
+        copy = table.to_metadata(metadata)
+        for constraint in [c for c in copy.constraints if isinstance(c, ForeignKeyConstraint)]:
+            copy.constraints.discard(constraint)
+        copy.foreign_keys.clear()
+        for column in copy.columns:
+            column.foreign_keys.clear()
+    metadata.create_all(engine)
@@ -0,0 +1,630 @@
+import functools
+from datetime import datetime
+from fastapi import HTTPException
+from typing import NamedTuple
+from sqlalchemy import BigInteger, and_, bindparam, delete, exists, func, insert, inspect, literal, or_, select, union_all, update
+from sqlalchemy.dialects import mysql, sqlite
+from starlette import status
+from database import mark_written, use_user
+from books import book_dictionary
+import models
+
+
+# A shelf is a table with the ShelfEntry columns plus the names it is exposed
+# under. Adding a shelf means one model in models.py and one entry here;
+# routes, the fast path and every operation below come from this registry.
+class Shelf(NamedTuple):
+    name: str           # used in request bodies, e.g. "to-read"
+    model: type
+    path: str           # route prefix, e.g. "/books-to-read"
+    response_key: str   # list key in GET responses, e.g. "books_to_read"
+    route_suffix: str   # endpoint names, e.g. add_book_to_read
+
+SHELVES = {shelf.name: shelf for shelf in (
+    Shelf("to-read", models.BooksToRead, "/books-to-read", "books_to_read", "to_read"),
+    Shelf("read", models.BooksRead, "/books-read", "books_read", "read"),
+    Shelf("reading", models.BooksReading, "/books-reading", "books_reading", "reading"),
+)}
+
+
+# Columns a client can ask for through ?fields=, and those returned without
+# it. position is null on shelves that are not ordered.
+FIELD_NAMES = ("id", "bookKey", "userId", "created_at", "updated_at", "position")
+SHELF_FIELDS = FIELD_NAMES[:-1]
+
+# Largest page a client can ask for through ?limit=
+MAX_PAGE_SIZE = 1000
+
+# Ordered shelves space positions this far apart when appending or
+# rebalancing, so a book can be moved between two others about 16 times in
+# the same spot before the gap runs out. A move that leaves a gap under
+# REBALANCE_GAP asks for a rebalance.
+POSITION_GAP = 1 << 16
+REBALANCE_GAP = 256
+
+
+# Splits "bookKey,created_at" into column names, rejecting unknown ones
+def parse_fields(fields: str | None):
+    if not fields:
+        return SHELF_FIELDS
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in FIELD_NAMES]
+    if unknown or not names:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(FIELD_NAMES)}"
+        )
+    return tuple(dict.fromkeys(names))
+
+
+# Hot statements are built once per shelf (and column list) with bound
+# parameters, so each call skips query construction and SQLAlchemy only
+# looks up the already-compiled SQL. Shelf rows store bookId; bookKey comes
+# from the books dictionary.
+def select_columns(model, fields, *extra):
+    columns = [
+        models.Book.bookKey if name == "bookKey"
+        else literal(None, BigInteger).label(name) if name == "position" and not ordered(model)
+        else getattr(model, name)
+        for name in fields
+    ]
+    statement = select(*extra, *columns).select_from(model)
+    if "bookKey" in fields:
+        statement = statement.join(models.Book, models.Book.id == model.bookId)
+    return statement
+
+# Shelves with a position column are listed in the user's order
+def ordered(model):
+    return "position" in model.__table__.c
+
+# The column a shelf is listed and paged by: position or id
+def cursor_column(model):
+    return model.position if ordered(model) else model.id
+
+@functools.cache
+def list_statement(model, fields):
+    statement = select_columns(model, fields).where(model.userId == bindparam("user_id"))
+    return statement.order_by(model.position) if ordered(model) else statement
+
+# Keyset pages in cursor order; "cursor" is the id (or position) the next
+# page starts after
+@functools.cache
+def page_statement(model, fields):
+    cursor = cursor_column(model)
+    return select_columns(model, fields, cursor.label("cursor")).where(
+        model.userId == bindparam("user_id"),
+        cursor > bindparam("after")
+    ).order_by(cursor).limit(bindparam("limit"))
+
+# Every shelf in one UNION ALL, ordered by (shelf, cursor). A page resumes
+# after (after_shelf, after_id); -1 starts at the first shelf.
+@functools.cache
+def library_statement(fields, paged: bool):
+    branches = []
+    for index, shelf in enumerate(SHELVES.values()):
+        model = shelf.model
+        cursor = cursor_column(model)
+        branches.append(select_columns(model, fields, literal(index).label("shelf"), cursor.label("cursor")).where(
+            model.userId == bindparam("user_id"),
+            or_(bindparam("after_shelf") < index, and_(bindparam("after_shelf") == index, cursor > bindparam("after_id")))
+        ))
+    library = union_all(*branches).subquery()
+    statement = select(library).order_by(library.c.shelf, library.c.cursor)
+    return statement.limit(bindparam("limit")) if paged else statement
+
+@functools.cache
+def keys_statement(model):
+    statement = select(models.Book.bookKey).join(model, models.Book.id == model.bookId).where(model.userId == bindparam("user_id"))
+    return statement.order_by(model.position) if ordered(model) else statement
+
+# Position reads lock what they read, so under REPEATABLE READ they see the
+# latest committed positions rather than the transaction's snapshot
+@functools.cache
+def last_position_statement(model):
+    return select(func.max(model.position)).where(model.userId == bindparam("user_id")).with_for_update()
+
+@functools.cache
+def position_statement(model):
+    return select(model.position).where(model.userId == bindparam("user_id"), model.bookId == bindparam("book_id")).with_for_update()
+
+# The first position after "after", ignoring the book being moved
+@functools.cache
+def next_position_statement(model):
+    return select(func.min(model.position)).where(
+        model.userId == bindparam("user_id"),
+        model.position > bindparam("after"),
+        model.bookId != bindparam("book_id")
+    ).with_for_update()
+
+@functools.cache
+def positions_statement(model):
+    return select(model.bookId, model.position).where(
+        model.userId == bindparam("user_id"),
+        model.bookId.in_(bindparam("book_ids", expanding=True))
+    )
+
+@functools.cache
+def set_position_statement(model):
+    return update(model).where(
+        model.userId == bindparam("user_id"),
+        model.bookId == bindparam("book_id")
+    ).values(position=bindparam("position")).execution_options(synchronize_session=False)
+
+@functools.cache
+def existing_ids_statement(model):
+    return select(model.bookId).where(
+        model.userId == bindparam("user_id"),
+        model.bookId.in_(bindparam("book_ids", expanding=True))
+    )
+
+@functools.cache
+def remove_statement(model):
+    return delete(model).where(
+        model.userId == bindparam("user_id"),
+        model.bookId.in_(bindparam("book_ids", expanding=True))
+    ).execution_options(synchronize_session=False)
+
+
+# Adds delta to a counter row, creating it if needed, in one statement
+@functools.cache
+def count_statement(dialect_name: str):
+    Count = models.ShelfCount
+    values = {"userId": bindparam("user_id"), "shelf": bindparam("shelf"), "count": bindparam("delta")}
+    if dialect_name == "mysql":
+        statement = mysql.insert(Count).values(values)
+        return statement.on_duplicate_key_update(count=Count.count + statement.inserted["count"])
+    statement = sqlite.insert(Count).values(values)
+    return statement.on_conflict_do_update(index_elements=["userId", "shelf"], set_={"count": Count.count + statement.excluded["count"]})
+
+# Raises a user's sync version by n, creating the row if needed
+@functools.cache
+def version_statement(dialect_name: str):
+    Version = models.UserVersion
+    values = {"userId": bindparam("user_id"), "version": bindparam("n")}
+    if dialect_name == "mysql":
+        statement = mysql.insert(Version).values(values)
+        return statement.on_duplicate_key_update(version=Version.version + statement.inserted["version"])
+    statement = sqlite.insert(Version).values(values)
+    return statement.on_conflict_do_update(index_elements=["userId"], set_={"version": Version.version + statement.excluded["version"]})
+
+VERSION_STATEMENT = select(models.UserVersion.version, models.UserVersion.compacted_through).where(models.UserVersion.userId == bindparam("user_id"))
+
+# A user's changes after a version, oldest first
+CHANGES_STATEMENT = select(
+    models.ShelfChange.version, models.ShelfChange.shelf, models.Book.bookKey, models.ShelfChange.removed,
+    models.ShelfChange.moved, models.ShelfChange.position
+).join(models.Book, models.Book.id == models.ShelfChange.bookId).where(
+    models.ShelfChange.userId == bindparam("user_id"),
+    models.ShelfChange.version > bindparam("since")
+).order_by(models.ShelfChange.version).limit(bindparam("limit"))
+
+# Per shelf and book: the newest change after since and when it was made.
+# Reorders do not conflict with adds and removes.
+EDITS_STATEMENT = select(
+    models.ShelfChange.shelf, models.ShelfChange.bookId,
+    func.max(models.ShelfChange.version).label("version"), func.max(models.ShelfChange.created_at).label("changed_at")
+).where(
+    models.ShelfChange.userId == bindparam("user_id"),
+    models.ShelfChange.version > bindparam("since"),
+    models.ShelfChange.bookId.in_(bindparam("book_ids", expanding=True)),
+    ~models.ShelfChange.moved
+).group_by(models.ShelfChange.shelf, models.ShelfChange.bookId)
+
+COUNTS_STATEMENT = select(models.ShelfCount.shelf, models.ShelfCount.count).where(models.ShelfCount.userId == bindparam("user_id"))
+
+
+# deltas maps shelf models to changes; all counters go in one executemany
+def adjust_counts(db, user_id: int, deltas):
+    dialect_name = db.get_bind(inspect(models.ShelfCount)).dialect.name
+    db.execute(count_statement(dialect_name), [
+        {"user_id": user_id, "shelf": model.__tablename__, "delta": delta} for model, delta in deltas.items() if delta
+    ])
+
+
+# Takes the lock on a user's version row (creating it if needed). Writes
+# that read before they write, such as sync merges and new positions on
+# ordered shelves, hold it so concurrent writes of the user queue up.
+def lock_version(db, user_id: int):
+    dialect_name = db.get_bind(inspect(models.UserVersion)).dialect.name
+    db.execute(version_statement(dialect_name), {"user_id": user_id, "n": 0})
+
+
+# Logs shelf changes for ?since= sync. changes is a list of
+# (model, book ids, removed); each row gets the next version of the user.
+# changed_at maps book ids to when a synced client made the change; other
+# changes are stamped with the current time. positions maps book ids to
+# their new position on an ordered shelf, for adds and (with moved set)
+# reorders.
+def record_changes(db, user_id: int, changes, changed_at=None, positions=None, moved: bool = False):
+    rows = [(model.__tablename__, book_id, removed) for model, book_ids, removed in changes for book_id in book_ids]
+    if not rows:
+        return
+    dialect_name = db.get_bind(inspect(models.UserVersion)).dialect.name
+    db.execute(version_statement(dialect_name), {"user_id": user_id, "n": len(rows)})
+    version = db.execute(VERSION_STATEMENT, {"user_id": user_id}).first().version
+    first = version - len(rows) + 1
+    now, changed_at, positions = models.utc_now(), changed_at or {}, positions or {}
+    db.execute(insert(models.ShelfChange), [
+        {
+            "userId": user_id, "version": first + offset, "shelf": shelf, "bookId": book_id, "removed": removed,
+            "moved": moved, "position": None if removed else positions.get(book_id), "created_at": changed_at.get(book_id, now)
+        }
+        for offset, (shelf, book_id, removed) in enumerate(rows)
+    ])
+
+
+# (version, compacted_through) of a user; (0, 0) before their first write
+def sync_version(db, user_id: int):
+    use_user(db, user_id)
+    row = db.execute(VERSION_STATEMENT, {"user_id": user_id}).first()
+    return (row.version, row.compacted_through) if row else (0, 0)
+
+
+# Adds and moves on ordered shelves carry the book's new position
+def change_row(row, names):
+    change = {"version": row.version, "shelf": names[row.shelf], "bookKey": row.bookKey, "op": "remove" if row.removed else "move" if row.moved else "add"}
+    if row.position is not None:
+        change["position"] = row.position
+    return change
+
+
+# Changes after since, at most limit of them. Returns the changes, the
+# version to pass as since next time and whether more are waiting. Raises
+# 410 when changes after since were already compacted away: the client has
+# to download the library again.
+def list_changes(db, user_id: int, since: int, limit: int = MAX_PAGE_SIZE):
+    version, compacted_through = sync_version(db, user_id)
+    if since < compacted_through:
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Changes since this version are no longer kept; reload the library")
+    rows = db.execute(CHANGES_STATEMENT, {"user_id": user_id, "since": since, "limit": limit + 1}).all()
+    names = {shelf.model.__tablename__: shelf.name for shelf in SHELVES.values()}
+    changes = [change_row(row, names) for row in rows[:limit]]
+    more = len(rows) > limit
+    latest = changes[-1]["version"] if changes else since
+    return changes, latest if more else max(version, latest), more
+
+
+# {response_key: count} for every shelf, from the counters
+def shelf_counts(db, user_id: int):
+    use_user(db, user_id)
+    counts = dict(db.execute(COUNTS_STATEMENT, {"user_id": user_id}).all())
+    return {shelf.response_key: counts.get(shelf.model.__tablename__, 0) for shelf in SHELVES.values()}
+
+
+# Copies a user's rows for the given books from source to target (skipping
+# books already on target) and deletes them from source. An ordered target
+# gets the books appended after position "base", in source id order.
+@functools.cache
+def move_statements(source, target):
+    columns = [source.bookId, source.userId]
+    if ordered(target):
+        columns.append(bindparam("base") + func.row_number().over(order_by=source.id) * POSITION_GAP)
+    rows = select(*columns).where(
+        source.userId == bindparam("user_id"),
+        source.bookId.in_(bindparam("book_ids", expanding=True)),
+        ~exists().where(target.userId == source.userId, target.bookId == source.bookId)
+    )
+    target_columns = [target.bookId, target.userId] + ([target.position] if ordered(target) else [])
+    copy = insert(target).from_select(target_columns, rows).execution_options(dml_strategy="raw")
+    return copy, remove_statement(source)
+
+
+# Lists a user's shelf selecting only the requested columns.
+# format="keys" returns a flat list of bookKey strings.
+def list_books(db, model, user_id: int, fields=SHELF_FIELDS, format: str = "objects"):
+    use_user(db, user_id)
+    if format == "keys":
+        return db.scalars(keys_statement(model), {"user_id": user_id}).all()
+    rows = db.execute(list_statement(model, tuple(fields)), {"user_id": user_id})
+    return [row._asdict() for row in rows]
+
+
+# Which shelves hold which of the given books, with one indexed IN per shelf
+@functools.cache
+def membership_statement():
+    return union_all(*(
+        select(literal(index).label("shelf"), shelf.model.bookId).where(
+            shelf.model.userId == bindparam("user_id"),
+            shelf.model.bookId.in_(bindparam("book_ids", expanding=True))
+        )
+        for index, shelf in enumerate(SHELVES.values())
+    ))
+
+
+def format_row(row, format: str):
+    if format == "keys":
+        return row.bookKey
+    return {name: value for name, value in row._asdict().items() if name not in ("cursor", "shelf")}
+
+
+# One page of a user's shelf in id order, starting after the row whose id is
+# after. Returns the books and the cursor of the next page (None at the end).
+def list_page(db, model, user_id: int, fields=SHELF_FIELDS, format: str = "objects", limit: int = MAX_PAGE_SIZE, after: int = 0):
+    use_user(db, user_id)
+    fields = ("bookKey",) if format == "keys" else tuple(fields)
+    rows = db.execute(page_statement(model, fields), {"user_id": user_id, "after": after, "limit": limit + 1}).all()
+    next_after = rows[limit - 1].cursor if len(rows) > limit else None
+    return [format_row(row, format) for row in rows[:limit]], next_after
+
+
+# Body and headers for GET {shelf.path}/{user_id}. Without limit or after
+# the whole shelf is returned; with them one keyset page, X-Next-After
+# carrying the cursor of the next one and X-Total-Count from the counters.
+def shelf_listing(db, shelf, user_id: int, fields=SHELF_FIELDS, format: str = "objects", limit: int | None = None, after: int | None = None):
+    if limit is None and after is None:
+        books = list_books(db, shelf.model, user_id, fields, format)
+        return {shelf.response_key: books}, {"X-Total-Count": str(len(books))}
+    books, next_after = list_page(db, shelf.model, user_id, fields, format, limit or MAX_PAGE_SIZE, after or 0)
+    headers = {"X-Total-Count": str(shelf_counts(db, user_id)[shelf.response_key])}
+    if next_after is not None:
+        headers["X-Next-After"] = str(next_after)
+    return {shelf.response_key: books}, headers
+
+
+# Splits a library cursor such as "read:42" into (shelf index, id)
+def parse_library_cursor(after: str | None):
+    if not after:
+        return -1, 0
+    name, _, row_id = after.partition(":")
+    names = list(SHELVES)
+    if name not in names or not row_id.isdigit():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    return names.index(name), int(row_id)
+
+
+# Body and headers for GET /library/{user_id}: every shelf from one query,
+# with the same fields, format and limit/after paging as a single shelf.
+# Library cursors name the shelf, e.g. "read:42". X-Sync-Version is read
+# before the shelves, so changes after it are at worst applied twice.
+def library_listing(db, user_id: int, fields=SHELF_FIELDS, format: str = "objects", limit: int | None = None, after: str | None = None):
+    after_shelf, after_id = parse_library_cursor(after)
+    version, _ = sync_version(db, user_id)
+    paged = limit is not None or after is not None
+    limit = limit or MAX_PAGE_SIZE
+    fields = ("bookKey",) if format == "keys" else tuple(fields)
+    rows = db.execute(
+        library_statement(fields, paged),
+        {"user_id": user_id, "after_shelf": after_shelf, "after_id": after_id, "limit": limit + 1},
+        # A union names no single entity; all shelf tables share the user's shard
+        bind_arguments={"mapper": inspect(models.BooksToRead)}
+    ).all()
+    shelves = list(SHELVES.values())
+    content = {shelf.response_key: [] for shelf in shelves}
+    for row in rows[:limit] if paged else rows:
+        content[shelves[row.shelf].response_key].append(format_row(row, format))
+    if not paged:
+        return content, {"X-Total-Count": str(len(rows)), "X-Sync-Version": str(version)}
+    headers = {"X-Total-Count": str(sum(shelf_counts(db, user_id).values())), "X-Sync-Version": str(version)}
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        headers["X-Next-After"] = f"{shelves[last.shelf].name}:{last.cursor}"
+    return content, headers
+
+
+# {bookKey: [shelf names]} for the given keys; keys on no shelf map to []
+def shelf_membership(db, user_id: int, book_keys):
+    use_user(db, user_id)
+    membership = {key: [] for key in book_keys}
+    book_ids = book_dictionary.get_ids(db, list(membership))
+    if book_ids:
+        keys_by_id = {book_id: key for key, book_id in book_ids.items()}
+        names = list(SHELVES)
+        rows = db.execute(
+            membership_statement(),
+            {"user_id": user_id, "book_ids": list(book_ids.values())},
+            bind_arguments={"mapper": inspect(models.BooksToRead)}
+        )
+        for shelf, book_id in rows:
+            membership[keys_by_id[book_id]].append(names[shelf])
+    return membership
+
+
+# {bookKey: [shelf names]} for every book the user has on any shelf
+def shelf_keys(db, user_id: int):
+    use_user(db, user_id)
+    rows = db.execute(
+        library_statement(("bookKey",), False),
+        {"user_id": user_id, "after_shelf": -1, "after_id": 0},
+        bind_arguments={"mapper": inspect(models.BooksToRead)}
+    )
+    names = list(SHELVES)
+    keys = {}
+    for row in rows:
+        keys.setdefault(row.bookKey, []).append(names[row.shelf])
+    return keys
+
+
+# Deletes keys from a user's shelf with one indexed DELETE and returns the
+# number of rows removed. changed_at optionally maps keys to the time a
+# synced client removed them, for the change log.
+def remove_books(db, model, user_id: int, book_keys, changed_at=None):
+    use_user(db, user_id, write=True)
+    book_ids = book_dictionary.get_ids(db, book_keys)
+    if not book_ids:
+        return 0
+    params = {"user_id": user_id, "book_ids": list(book_ids.values())}
+    on_shelf = db.scalars(existing_ids_statement(model), params).all()
+    if not on_shelf:
+        return 0
+    removed = db.execute(remove_statement(model), {"user_id": user_id, "book_ids": on_shelf}).rowcount
+    if removed:
+        adjust_counts(db, user_id, {model: -removed})
+        record_changes(db, user_id, [(model, on_shelf, True)], changed_at and {book_ids[key]: moment for key, moment in changed_at.items() if key in book_ids})
+        mark_written(db, user_id)
+    return removed
+
+
+# Adds keys to a user's shelf with one executemany INSERT, skipping keys that
+# are already there. Keys new to the dictionary are added to it first.
+# changed_at is as for remove_books. Returns the keys that were added.
+def add_books(db, model, user_id: int, book_keys, changed_at=None):
+    use_user(db, user_id, write=True)
+    keys = list(dict.fromkeys(book_keys))
+    book_ids = book_dictionary.get_ids(db, keys, create=True)
+    existing = set(db.scalars(existing_ids_statement(model), {"user_id": user_id, "book_ids": list(book_ids.values())}))
+    new_keys = [key for key in keys if book_ids[key] not in existing]
+    if new_keys:
+        rows = [{"bookId": book_ids[key], "userId": user_id} for key in new_keys]
+        if ordered(model):
+            lock_version(db, user_id)
+            base = db.scalar(last_position_statement(model), {"user_id": user_id}) or 0
+            for offset, row in enumerate(rows, 1):
+                row["position"] = base + offset * POSITION_GAP
+        db.execute(insert(model), rows)
+        adjust_counts(db, user_id, {model: len(new_keys)})
+        record_changes(
+            db, user_id, [(model, [row["bookId"] for row in rows], False)],
+            changed_at and {book_ids[key]: changed_at[key] for key in new_keys if key in changed_at},
+            {row["bookId"]: row["position"] for row in rows if "position" in row}
+        )
+        mark_written(db, user_id)
+    return new_keys
+
+
+# Moves keys from one shelf to another in the caller's transaction with an
+# INSERT ... SELECT and a DELETE, so a book is never on neither shelf.
+# Returns the number of books taken off the source shelf.
+def move_books(db, source, target, user_id: int, book_keys):
+    use_user(db, user_id, write=True)
+    book_ids = list(book_dictionary.get_ids(db, dict.fromkeys(book_keys)).values())
+    if not book_ids:
+        return 0
+    on_source = db.scalars(existing_ids_statement(source), {"user_id": user_id, "book_ids": book_ids}).all()
+    if not on_source:
+        return 0
+    copy, remove = move_statements(source, target)
+    params = {"user_id": user_id, "book_ids": on_source}
+    if ordered(target):
+        lock_version(db, user_id)
+        params["base"] = db.scalar(last_position_statement(target), {"user_id": user_id}) or 0
+    added = db.execute(copy, params).rowcount
+    removed = db.execute(remove, params).rowcount
+    if removed:
+        adjust_counts(db, user_id, {source: -removed, target: added})
+        positions = dict(db.execute(positions_statement(target), params).all()) if ordered(target) else None
+        record_changes(db, user_id, [(source, on_source, True), (target, on_source, False)], positions=positions)
+        mark_written(db, user_id)
+    return removed
+
+
+# Moves a book on an ordered shelf to just after after_key (None: to the top)
+# by giving it a position between its new neighbours, so only its row
+# changes. Returns whether the gaps around it got small enough that the
+# user's positions should be rebalanced. Rebalances first when there is no
+# free position left between the neighbours.
+def reorder_book(db, model, user_id: int, book_key: str, after_key: str | None = None):
+    use_user(db, user_id, write=True)
+    if after_key == book_key:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="A book cannot be placed after itself")
+    book_ids = book_dictionary.get_ids(db, [book_key] + ([after_key] if after_key is not None else []))
+    if book_key not in book_ids or (after_key is not None and after_key not in book_ids):
+        raise HTTPException(status_code=404, detail="Books not found")
+    book_id, after_id = book_ids[book_key], book_ids.get(after_key)
+    lock_version(db, user_id)
+    lower, upper = neighbour_positions(db, model, user_id, book_id, after_id)
+    if upper is not None and upper - lower < 2:
+        rebalance_positions(db, model, user_id)
+        lower, upper = neighbour_positions(db, model, user_id, book_id, after_id)
+    position = lower + POSITION_GAP if upper is None else (lower + upper) // 2
+    if not db.execute(set_position_statement(model), {"user_id": user_id, "book_id": book_id, "position": position}).rowcount:
+        raise HTTPException(status_code=404, detail="Books not found")
+    record_changes(db, user_id, [(model, [book_id], False)], positions={book_id: position}, moved=True)
+    mark_written(db, user_id)
+    return upper is not None and min(position - lower, upper - position) < REBALANCE_GAP
+
+
+# Positions a book moved after after_id (None: to the top) goes between; the
+# upper one is None at the end of the shelf
+def neighbour_positions(db, model, user_id: int, book_id: int, after_id: int | None):
+    lower = 0
+    if after_id is not None:
+        lower = db.scalar(position_statement(model), {"user_id": user_id, "book_id": after_id})
+        if lower is None:
+            raise HTTPException(status_code=404, detail="Books not found")
+    upper = db.scalar(next_position_statement(model), {"user_id": user_id, "after": lower, "book_id": book_id})
+    return lower, upper
+
+
+# Spreads a user's positions POSITION_GAP apart again, keeping their order.
+# Positions are negated first so the new ones never collide with old ones
+# under the unique (userId, position) index. Every book is logged as moved
+# to its new position.
+def rebalance_positions(db, model, user_id: int):
+    use_user(db, user_id, write=True)
+    lock_version(db, user_id)
+    rows = db.execute(select(model.id, model.bookId).where(model.userId == user_id).order_by(model.position).with_for_update()).all()
+    if not rows:
+        return
+    db.execute(
+        update(model).where(model.userId == user_id).values(position=-model.position, updated_at=model.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+    # An executemany UPDATE goes through the table; the mapper picks the shard
+    table = model.__table__
+    db.execute(
+        update(table).where(table.c.userId == bindparam("user_id"), table.c.id == bindparam("row_id")).values(position=bindparam("new_position"), updated_at=table.c.updated_at),
+        [{"user_id": user_id, "row_id": row.id, "new_position": offset * POSITION_GAP} for offset, row in enumerate(rows, 1)],
+        bind_arguments={"mapper": inspect(model)}
+    )
+    positions = {row.bookId: offset * POSITION_GAP for offset, row in enumerate(rows, 1)}
+    record_changes(db, user_id, [(model, list(positions), False)], positions=positions, moved=True)
+    mark_written(db, user_id)
+
+
+# One entry of an offline client's change log. version is the sync version
+# the client had seen when it made the change; updated_at is in UTC.
+class ClientChange(NamedTuple):
+    shelf: str
+    book_key: str
+    op: str             # "add" or "remove"
+    updated_at: datetime
+    version: int
+
+
+# Merges a client's change log into a user's shelves. A change conflicts
+# when the server changed the same book on the same shelf after the
+# change's version; then the later updated_at wins, ties going to the
+# server. Only the last change per shelf and book counts. Returns the
+# rejected changes plus the list_changes page after since, which holds the
+# accepted ones. The number of queries depends on the number of shelves,
+# not on the number of changes.
+def sync_library(db, user_id: int, since: int, changes, limit: int = MAX_PAGE_SIZE):
+    use_user(db, user_id, write=True)
+    # No other write lands between the conflict check and the merge
+    lock_version(db, user_id)
+    version, compacted_through = db.execute(VERSION_STATEMENT, {"user_id": user_id}).first()
+    versions = [since] + [change.version for change in changes]
+    if min(versions) < compacted_through:
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Changes since this version are no longer kept; reload the library")
+    if max(versions) > version:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Version is ahead of the server")
+
+    latest = {}
+    for change in changes:
+        item = (change.shelf, change.book_key)
+        if item not in latest or change.updated_at >= latest[item].updated_at:
+            latest[item] = change
+    book_ids = book_dictionary.get_ids(db, dict.fromkeys(change.book_key for change in latest.values()))
+    edits = {}
+    if book_ids:
+        params = {"user_id": user_id, "since": min(versions), "book_ids": list(book_ids.values())}
+        edits = {(row.shelf, row.bookId): row for row in db.execute(EDITS_STATEMENT, params)}
+
+    rejected = []
+    accepted = {(op, name): [] for op in ("remove", "add") for name in SHELVES}
+    for change in latest.values():
+        edit = edits.get((SHELVES[change.shelf].model.__tablename__, book_ids.get(change.book_key)))
+        if edit is not None and edit.version > change.version and change.updated_at <= edit.changed_at:
+            rejected.append({"shelf": change.shelf, "bookKey": change.book_key, "op": change.op})
+        else:
+            accepted[change.op, change.shelf].append(change.book_key)
+    # Every remove runs before any add, as in a move. Accepted changes are
+    # logged with their updated_at, so later conflicts compare edit times.
+    for (op, name), keys in accepted.items():
+        changed_at = {key: latest[name, key].updated_at for key in keys}
+        if keys and op == "remove":
+            remove_books(db, SHELVES[name].model, user_id, keys, changed_at)
+        elif keys:
+            add_books(db, SHELVES[name].model, user_id, keys, changed_at)
+    changes, version, more = list_changes(db, user_id, since, limit)
+    return rejected, changes, version, more
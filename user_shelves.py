@@ -0,0 +1,143 @@
+from fastapi import HTTPException
+from sqlalchemy import bindparam, delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from starlette import status
+from database import mark_written, use_user
+from books import book_dictionary
+from shelves import MAX_PAGE_SIZE
+import models
+
+Shelf = models.UserShelf
+ShelfBook = models.UserShelfBook
+
+# Most shelves one user can create
+MAX_USER_SHELVES = 1000
+
+SHELVES_STATEMENT = select(Shelf.id, Shelf.name, Shelf.book_count).where(Shelf.userId == bindparam("user_id")).order_by(Shelf.name)
+
+# The user's shelves holding one book, from the (userId, bookId, shelfId) index
+BOOK_SHELVES_STATEMENT = select(Shelf.id, Shelf.name, Shelf.book_count).join(ShelfBook, ShelfBook.shelfId == Shelf.id).where(
+    ShelfBook.userId == bindparam("user_id"),
+    ShelfBook.bookId == bindparam("book_id")
+).order_by(Shelf.name)
+
+SHELF_COUNT_STATEMENT = select(func.count()).select_from(Shelf).where(Shelf.userId == bindparam("user_id"))
+
+# Locks the shelf row, so concurrent changes to one shelf's books and its
+# book_count are applied one after the other
+SHELF_STATEMENT = select(Shelf.book_count).where(Shelf.id == bindparam("shelf_id"), Shelf.userId == bindparam("user_id"))
+
+EXISTING_STATEMENT = select(ShelfBook.bookId).where(
+    ShelfBook.shelfId == bindparam("shelf_id"),
+    ShelfBook.bookId.in_(bindparam("book_ids", expanding=True))
+)
+
+REMOVE_STATEMENT = delete(ShelfBook).where(
+    ShelfBook.shelfId == bindparam("shelf_id"),
+    ShelfBook.bookId.in_(bindparam("book_ids", expanding=True))
+).execution_options(synchronize_session=False)
+
+COUNT_STATEMENT = update(Shelf).where(Shelf.id == bindparam("shelf_id")).values(
+    book_count=Shelf.book_count + bindparam("delta")
+).execution_options(synchronize_session=False)
+
+# Keyset pages of a shelf's books in bookId order, from the primary key
+PAGE_STATEMENT = select(ShelfBook.bookId.label("cursor"), models.Book.bookKey, ShelfBook.created_at).join(
+    models.Book, models.Book.id == ShelfBook.bookId
+).where(
+    ShelfBook.shelfId == bindparam("shelf_id"),
+    ShelfBook.bookId > bindparam("after")
+).order_by(ShelfBook.bookId).limit(bindparam("limit"))
+
+
+def shelf_row(row):
+    return {"id": row.id, "name": row.name, "count": row.book_count}
+
+
+# A user's shelves by name with their sizes; with book_key only the shelves
+# holding that book
+def list_user_shelves(db, user_id: int, book_key: str | None = None):
+    use_user(db, user_id)
+    if book_key is None:
+        return [shelf_row(row) for row in db.execute(SHELVES_STATEMENT, {"user_id": user_id})]
+    book_id = book_dictionary.get_ids(db, [book_key]).get(book_key)
+    if book_id is None:
+        return []
+    return [shelf_row(row) for row in db.execute(BOOK_SHELVES_STATEMENT, {"user_id": user_id, "book_id": book_id})]
+
+
+def create_user_shelf(db, user_id: int, name: str):
+    use_user(db, user_id, write=True)
+    if db.scalar(SHELF_COUNT_STATEMENT, {"user_id": user_id}) >= MAX_USER_SHELVES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"A user can have at most {MAX_USER_SHELVES} shelves")
+    savepoint = db.begin_nested()
+    try:
+        shelf_id = db.execute(insert(Shelf).values(userId=user_id, name=name)).inserted_primary_key[0]
+        savepoint.commit()
+    except IntegrityError:
+        savepoint.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="A shelf with this name already exists")
+    mark_written(db, user_id)
+    return {"id": shelf_id, "name": name, "count": 0}
+
+
+# The shelf's book_count, locking its row; 404 when the user has no such shelf
+def lock_shelf(db, user_id: int, shelf_id: int):
+    count = db.scalar(SHELF_STATEMENT.with_for_update(), {"user_id": user_id, "shelf_id": shelf_id})
+    if count is None:
+        raise HTTPException(status_code=404, detail="Shelf not found")
+    return count
+
+
+def delete_user_shelf(db, user_id: int, shelf_id: int):
+    use_user(db, user_id, write=True)
+    lock_shelf(db, user_id, shelf_id)
+    db.execute(delete(ShelfBook).where(ShelfBook.shelfId == shelf_id))
+    db.execute(delete(Shelf).where(Shelf.id == shelf_id))
+    mark_written(db, user_id)
+
+
+# Adds keys to a shelf with one executemany INSERT, skipping books already
+# on it. Returns the keys that were added.
+def add_to_user_shelf(db, user_id: int, shelf_id: int, book_keys):
+    use_user(db, user_id, write=True)
+    lock_shelf(db, user_id, shelf_id)
+    keys = list(dict.fromkeys(book_keys))
+    book_ids = book_dictionary.get_ids(db, keys, create=True)
+    existing = set(db.scalars(EXISTING_STATEMENT, {"shelf_id": shelf_id, "book_ids": list(book_ids.values())}))
+    new_keys = [key for key in keys if book_ids[key] not in existing]
+    if new_keys:
+        db.execute(insert(ShelfBook), [{"shelfId": shelf_id, "bookId": book_ids[key], "userId": user_id} for key in new_keys])
+        db.execute(COUNT_STATEMENT, {"shelf_id": shelf_id, "delta": len(new_keys)})
+        mark_written(db, user_id)
+    return new_keys
+
+
+# Takes keys off a shelf; returns the number of books removed
+def remove_from_user_shelf(db, user_id: int, shelf_id: int, book_keys):
+    use_user(db, user_id, write=True)
+    lock_shelf(db, user_id, shelf_id)
+    book_ids = list(book_dictionary.get_ids(db, dict.fromkeys(book_keys)).values())
+    if not book_ids:
+        return 0
+    removed = db.execute(REMOVE_STATEMENT, {"shelf_id": shelf_id, "book_ids": book_ids}).rowcount
+    if removed:
+        db.execute(COUNT_STATEMENT, {"shelf_id": shelf_id, "delta": -removed})
+        mark_written(db, user_id)
+    return removed
+
+
+# Body and headers for one page of a shelf's books, like shelves.shelf_listing:
+# X-Total-Count from book_count, X-Next-After with the next page's cursor
+def user_shelf_listing(db, user_id: int, shelf_id: int, format: str = "objects", limit: int | None = None, after: int | None = None):
+    use_user(db, user_id)
+    count = db.scalar(SHELF_STATEMENT, {"user_id": user_id, "shelf_id": shelf_id})
+    if count is None:
+        raise HTTPException(status_code=404, detail="Shelf not found")
+    limit = limit or MAX_PAGE_SIZE
+    rows = db.execute(PAGE_STATEMENT, {"shelf_id": shelf_id, "after": after or 0, "limit": limit + 1}).all()
+    books = [row.bookKey if format == "keys" else {"bookKey": row.bookKey, "created_at": row.created_at} for row in rows[:limit]]
+    headers = {"X-Total-Count": str(count)}
+    if len(rows) > limit:
+        headers["X-Next-After"] = str(rows[limit - 1].cursor)
+    return {"books": books}, headers